@@ -1,23 +1,19 @@
+import functools
 from typing import Optional
 from pathlib import Path
-from pydantic import Field, BaseModel
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-class EnvSettings(BaseSettings):
-    openrouter_api_key: Optional[str] = Field(None, validation_alias="OPENROUTER_API_KEY")
-    
+class Settings(BaseSettings):
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
         extra="ignore"
     )
 
-_env_loader = EnvSettings()
-
-class Settings(BaseModel):
     # Secrets
-    openrouter_api_key: Optional[str] = _env_loader.openrouter_api_key
-    
+    openrouter_api_key: Optional[str] = Field(None, validation_alias="OPENROUTER_API_KEY")
+
     # Core
     openai_base_url: str = "https://openrouter.ai/api/v1"
     
@@ -34,15 +30,43 @@ class Settings(BaseModel):
     max_workers: int = 4
     dpi: int = 200
     caption_slide_pngs: bool = True
+
+    # Vision payload
+    vision_max_side: int = 1280
+    vision_jpeg_quality: int = 80
+    vision_detail: str = "low"
     
     # Glitch Fix
     glitch_fix_with_png: bool = True
     glitch_fix_batch_size: int = 5
+    glitch_fix_workers: int = 4
+    vision_max_images_per_request: int = 20
     
     # Rewrite
     rewrite_max_output_tokens: int = 1200
+    clean_workers: int = 8
+    clean_batch_size: int = 10
     
+    # Prompt payload budgets (input tokens, measured with tiktoken)
+    summary_token_budget: int = 60000
+    synthesis_token_budget: int = 180000
+
     # Synthesis
     synthesis_max_output_tokens: int = 500000
 
-settings = Settings()
+    # Provider Batch API (50% cost, minutes-to-hours latency) for the
+    # offline synthesis path
+    use_batch_api: bool = False
+
+    # LLM response cache
+    llm_cache: bool = True
+    llm_cache_all: bool = False  # also cache calls with temperature > 0
+    llm_cache_dir: Path = Path(".llm_cache")
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Builds the Settings object once per process; .env is only parsed on
+    the first call no matter how many modules import the config."""
+    return Settings()
+
+settings = get_settings()
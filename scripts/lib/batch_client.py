@@ -0,0 +1,105 @@
+"""
+OpenAI-compatible Batch API client for offline-friendly calls.
+
+Batched requests cost half as much and queue at higher throughput than
+interactive completions, at the price of latency (minutes to hours).
+That trade only makes sense for the overnight-style `process` command,
+so everything here is gated behind settings.use_batch_api.
+"""
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from openai import OpenAI
+
+from scripts.config import settings
+from scripts.util import jsonio
+
+_POLL_INTERVAL_S = 30.0
+_TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _client() -> OpenAI:
+    return OpenAI(
+        api_key=settings.openrouter_api_key,
+        base_url=settings.openai_base_url,
+    )
+
+
+def build_request(
+    custom_id: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    temperature: float = 0.0,
+    max_output_tokens: Optional[int] = None,
+) -> dict:
+    """One /v1/chat/completions line of a batch input file."""
+    body: dict = {
+        "model": model,
+        "temperature": temperature,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+    }
+    if max_output_tokens is not None:
+        body["max_tokens"] = max_output_tokens
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body,
+    }
+
+
+def submit_batch(requests: List[dict], timeout_s: float = 24 * 3600) -> Dict[str, str]:
+    """
+    Uploads the requests as one batch job, polls until it finishes, and
+    returns response text keyed by custom_id. Failed lines are simply
+    absent from the result, so callers can fall back per request.
+    """
+    client = _client()
+
+    with tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False) as f:
+        for req in requests:
+            f.write(jsonio.dumps_bytes(req, indent=False) + b"\n")
+        input_path = Path(f.name)
+
+    try:
+        with open(input_path, "rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+    finally:
+        input_path.unlink(missing_ok=True)
+
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"[info] Submitted batch {batch.id} ({len(requests)} request(s)). Polling...")
+
+    deadline = time.monotonic() + timeout_s
+    while batch.status not in _TERMINAL_STATES:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Batch {batch.id} timed out in state {batch.status}")
+        time.sleep(_POLL_INTERVAL_S)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended in state {batch.status}")
+
+    raw = client.files.content(batch.output_file_id).content
+    results: Dict[str, str] = {}
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        rec = jsonio.loads(line)
+        response = rec.get("response") or {}
+        if response.get("status_code") == 200:
+            body = response.get("body") or {}
+            choices = body.get("choices") or []
+            if choices:
+                results[rec["custom_id"]] = choices[0]["message"]["content"]
+    return results
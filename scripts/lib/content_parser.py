@@ -1,11 +1,15 @@
+import asyncio
+import functools
+import hashlib
+import os
 import re
-import json
 from dataclasses import dataclass, asdict
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 
 from scripts.config import settings
-from scripts.lib.llm import call_text, call_vision
+from scripts.lib.llm import call_text, acall_text, call_vision, acall_vision
+from scripts.util import jsonio
 
 @dataclass
 class SlideBlock:
@@ -15,69 +19,257 @@ class SlideBlock:
     slide_png: str
     extracted_images: List[str]
 
-SLIDE_HEADER_RE = re.compile(r"^(#{1,3})\s+(.*)\s*$")
+# [ \t]+ rather than \s+: in MULTILINE mode \s matches newlines, which
+# would let a bare '#' body line swallow the following line as its title.
+SLIDE_HEADER_RE = re.compile(r"(?m)^(#{1,3})[ \t]+(.*?)[ \t\r]*$")
+IMG_RE = re.compile(r"!\[[^\]]*\]\(([^)]+)\)")
+# Anchored to the line start: the model emits each delimiter on its own
+# line, and anchoring keeps a slide that *mentions* the marker mid-text
+# from being mistaken for a boundary (it also lets the scan skip
+# non-line-start positions cheaply).
+_SLIDE_DELIM_RE = re.compile(r"(?m)^=== SLIDE\s+(\d+)\s*===")
+
+# Keep this byte-identical across batches: providers cache shared prompt
+# prefixes, so all instructions live here and only per-slide content goes
+# in the user message.
+_VISION_FIX_SYSTEM = "\n".join([
+    "Refine slide text from images. Keep format. Output ONLY the content for each slide.",
+    "Correct the markdown text for these slides using the images.",
+    "Strictly follow the order. Use delimiters '=== SLIDE N ===' where N is the slide number provided below.",
+    "After the final slide, output '=== END ===' on its own line.",
+    "IMPORTANT: Output ONLY the requested format. No conversational filler.",
+])
 
 def parse_slides_md(md_text: str) -> List[tuple[str, str]]:
-    """Splits markdown into (title, body) tuples based on headers."""
-    lines = md_text.splitlines()
-    heading_idxs = []
-    for i, line in enumerate(lines):
-        m = SLIDE_HEADER_RE.match(line)
-        if m:
-            level = len(m.group(1))
-            heading_idxs.append((i, level, m.group(2).strip()))
-
-    if not heading_idxs:
+    """Splits markdown into (title, body) tuples based on headers.
+
+    A single MULTILINE finditer pass locates all headings; section bodies
+    are slices of the original text, so no per-line list or join copies
+    are made.
+    """
+    headings = [
+        (m.start(), m.end(), len(m.group(1)), m.group(2).strip())
+        for m in SLIDE_HEADER_RE.finditer(md_text)
+    ]
+
+    if not headings:
         return [("Lecture", md_text.strip())]
 
-    levels = [lvl for _, lvl, _ in heading_idxs]
+    levels = [lvl for _, _, lvl, _ in headings]
     # Prefer level 2, else 1
     split_level = 2 if 2 in levels else 1
-    splits = [(i, title) for i, lvl, title in heading_idxs if lvl == split_level]
-    
+    splits = [(start, end, title) for start, end, lvl, title in headings if lvl == split_level]
+
     if not splits:
         split_level = min(levels)
-        splits = [(i, title) for i, lvl, title in heading_idxs if lvl == split_level]
+        splits = [(start, end, title) for start, end, lvl, title in headings if lvl == split_level]
 
     sections = []
-    for j, (start_idx, title) in enumerate(splits):
-        end_idx = splits[j + 1][0] if j + 1 < len(splits) else len(lines)
-        body = "\n".join(lines[start_idx + 1 : end_idx]).strip()
+    for j, (start, end, title) in enumerate(splits):
+        body_end = splits[j + 1][0] if j + 1 < len(splits) else len(md_text)
+        body = md_text[end:body_end].strip()
         sections.append((title, body))
     return sections
 
+@functools.lru_cache(maxsize=2048)
+def _file_digest(path: str, mtime_ns: int) -> str:
+    """Content fingerprint of an image file. Only the first 64KB is hashed
+    — plenty to distinguish image files without reading multi-MB PNGs."""
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(65536), digest_size=16).hexdigest()
+
 def find_extracted_images(body_md: str) -> List[str]:
-    imgs = re.findall(r"!\[[^\]]*\]\(([^)]+)\)", body_md)
+    imgs = IMG_RE.findall(body_md)
     out = []
     for p in imgs:
         p = p.strip()
         # Clean paths like ./img/ -> img/
-        clean_p = p.replace("./", "")
+        clean_p = p.removeprefix("./")
         if clean_p.startswith("img/"):
             out.append(clean_p)
     return out
 
 from tqdm import tqdm
 
-def clean_body_md(title: str, body: str) -> str:
-    # Text-only quick fix
-    prompt = (
+_CTRL_CHAR_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _looks_clean(body: str) -> bool:
+    """
+    Cheap local heuristic: True when the body shows no signs of OCR junk,
+    so the per-slide LLM fix can be skipped entirely. Most pptx2md output
+    needs no cleanup — this avoids one remote call per clean slide.
+    """
+    stripped = body.strip()
+    if len(stripped) <= 20:
+        return False
+    if _CTRL_CHAR_RE.search(body):
+        return False
+    if "   " in body:
+        return False
+    if "�" in body or "□" in body:
+        return False
+    if "![]()" in body:
+        return False
+    # Unbalanced inline math is a common extraction glitch
+    if body.count("$") % 2 != 0:
+        return False
+    if body.count("\\(") != body.count("\\)"):
+        return False
+    return True
+
+def needs_vision_fix(body: str) -> bool:
+    """
+    Cheap filter in front of the vision cleanup: only slides whose
+    extracted markdown shows real damage are worth a vision round-trip.
+    Deliberately looser than _looks_clean — vision calls are an order of
+    magnitude more expensive than text fixes, so minor cosmetic issues
+    don't qualify.
+    """
+    stripped = body.strip()
+    if len(stripped) < 30:
+        return True
+    if "�" in body or "□" in body:
+        return True
+    if _CTRL_CHAR_RE.search(body):
+        return True
+    if body.count("$") % 2 != 0:
+        return True
+    if body.count("?") / max(len(body), 1) > 0.2:
+        return True
+    return False
+
+_CLEAN_SYSTEM = "Fix typos/spacing/OCR junk only. Output ONLY the fixed text."
+
+def _clean_prompt(title: str, body: str) -> str:
+    return (
         "Fix obvious OCR/transcription glitches. Keep format/math. No summarizing.\n"
         "IMPORTANT: Output ONLY the corrected text. Do NOT say 'Okay I will fix' or provide any preamble.\n"
         f"Title: {title}\nBody:\n{body}"
     )
+
+def clean_body_md(title: str, body: str) -> str:
+    # Text-only quick fix
+    if _looks_clean(body):
+        return body
+
     try:
         return call_text(
             model=settings.mini_text_model,
-            system_prompt="Fix typos/spacing/OCR junk only. Output ONLY the fixed text.",
-            user_prompt=prompt,
+            system_prompt=_CLEAN_SYSTEM,
+            user_prompt=_clean_prompt(title, body),
             temperature=0.0,
             max_output_tokens=2000
         ).strip()
     except Exception:
         return body
 
-def batch_clean_bodies_vision(
+async def aclean_body_md(title: str, body: str) -> str:
+    """Async counterpart of clean_body_md."""
+    if _looks_clean(body):
+        return body
+
+    try:
+        out = await acall_text(
+            model=settings.mini_text_model,
+            system_prompt=_CLEAN_SYSTEM,
+            user_prompt=_clean_prompt(title, body),
+            temperature=0.0,
+            max_output_tokens=2000
+        )
+        return out.strip()
+    except Exception:
+        return body
+
+# Static instructions (prefix-cacheable); per-slide content goes in the
+# user message. JSON output keeps per-slide boundaries machine-parseable.
+_BATCH_TEXT_SYSTEM = "\n".join([
+    "You fix slide markdown.",
+    "Fix typos/spacing/OCR junk and corrupted formulas/placeholders. Keep structure/tables/bullets. No summarizing.",
+    'Output ONLY a JSON array: [{"idx": <slide number>, "body": "<fixed markdown>"}] covering every slide given.',
+    "No code fences, no commentary.",
+])
+
+async def abatch_clean_rewrite(
+    titles: List[str],
+    bodies: List[str],
+    on_batch: Callable[[List[Tuple[int, str]]], None] = None,
+) -> List[str]:
+    """
+    Cleans and rewrites slides in multi-slide batches: K slides share one
+    round-trip instead of two calls each, which removes most of the
+    network and queueing latency of the text cleanup pass. Batches run
+    concurrently under a semaphore; any batch whose JSON response cannot
+    be parsed falls back to the per-slide clean+rewrite chain.
+
+    on_batch, if given, is called with each batch's (index, body) pairs
+    as that batch completes — callers use it to persist results
+    incrementally so a crash mid-pass keeps the batches already paid for.
+    """
+    final = list(bodies)
+    batch_size = settings.clean_batch_size
+
+    async def _fallback_one(g_idx: int) -> Tuple[int, str]:
+        body = await aclean_body_md(titles[g_idx], bodies[g_idx])
+        body = await arewrite_body_md(titles[g_idx], body)
+        return g_idx, body
+
+    async def _process_one_batch(start: int) -> List[Tuple[int, str]]:
+        end = min(len(bodies), start + batch_size)
+        idxs = list(range(start, end))
+
+        prompt_lines = []
+        for local, g_idx in enumerate(idxs, start=1):
+            prompt_lines.extend([
+                f"=== SLIDE {local} ===",
+                f"Title: {titles[g_idx]}",
+                f"Markdown:\n{bodies[g_idx]}",
+                ""
+            ])
+
+        try:
+            out = await acall_text(
+                model=settings.text_model,
+                system_prompt=_BATCH_TEXT_SYSTEM,
+                user_prompt="\n".join(prompt_lines),
+                temperature=0.0,
+                max_output_tokens=settings.rewrite_max_output_tokens * len(idxs),
+            )
+            raw = out.strip()
+            if raw.startswith("```"):
+                raw = raw.split("```")[1]
+                raw = raw.removeprefix("json").strip()
+            items = jsonio.loads(raw)
+            results = []
+            for item in items:
+                local = int(item["idx"])
+                if 1 <= local <= len(idxs):
+                    results.append((idxs[local - 1], str(item["body"])))
+            if len(results) != len(idxs):
+                raise ValueError(f"batch returned {len(results)}/{len(idxs)} slides")
+            return results
+        except Exception as e:
+            print(f"[warn] batch text fix failed ({e}); falling back per slide")
+            return list(await asyncio.gather(*[_fallback_one(g) for g in idxs]))
+
+    starts = list(range(0, len(bodies), batch_size))
+    sem = asyncio.Semaphore(settings.clean_workers)
+
+    async def _bounded(start: int) -> List[Tuple[int, str]]:
+        async with sem:
+            return await _process_one_batch(start)
+
+    with tqdm(total=len(starts), desc="Text Cleanup", unit="batch") as pbar:
+        for coro in asyncio.as_completed([_bounded(s) for s in starts]):
+            pairs = await coro
+            for g_idx, body in pairs:
+                final[g_idx] = body
+            if on_batch is not None and pairs:
+                on_batch(pairs)
+            pbar.update(1)
+
+    return final
+
+async def abatch_clean_bodies_vision(
     lecture_dir: Path,
     titles: List[str],
     bodies: List[str],
@@ -85,97 +277,176 @@ def batch_clean_bodies_vision(
 ) -> List[str]:
     """
     Refines slide text using the vision model and slide PNGs.
-    Batches requests to save calls.
+    Batches requests to save calls; batches run concurrently under a
+    semaphore sized by settings.glitch_fix_workers.
     """
     if not settings.glitch_fix_with_png:
         return bodies
 
     final_cleaned = list(bodies)
     batch_size = settings.glitch_fix_batch_size
-    
-    # Process in chunks with TQDM
-    total_batches = (len(bodies) + batch_size - 1) // batch_size
-    
-    for start in tqdm(range(0, len(bodies), batch_size), desc="Vision Cleanup", total=total_batches, unit="batch"):
+
+    async def _process_one_batch(start: int) -> List[Tuple[int, str]]:
+        """Runs one vision batch; returns (global_idx, cleaned_body) pairs."""
         end = min(len(bodies), start + batch_size)
-        
-        batch_indices = range(start, end) # Global indices
-        
-        valid_batch_items = [] # (global_idx, title, body, img_path)
-        
-        for g_idx in batch_indices:
+
+        valid_batch_items = []  # (global_idx, title, body, img_paths)
+        seen_digests = set()
+        # Providers cap multimodal parts per request; slide screenshots
+        # are essential, extracted figures are attached only while the
+        # request stays under the cap.
+        max_imgs = settings.vision_max_images_per_request
+        total_imgs = 0
+        for g_idx in range(start, end):
             t = titles[g_idx]
             b = bodies[g_idx]
             rel = slide_png_rels[g_idx]
-            img_abs = lecture_dir / rel
-            if img_abs.exists():
-                valid_batch_items.append((g_idx, t, b, str(img_abs)))
-        
+            img_abs = os.fspath(lecture_dir / rel)
+            try:
+                os.stat(img_abs)
+            except OSError:
+                continue
+            # Ship the slide's extracted figures in the same call — one
+            # round-trip per slide group instead of one per image, and the
+            # prompt text isn't repeated per image. Decks repeat logos and
+            # footers everywhere, so byte-identical figures (by content
+            # hash) are only attached once per batch.
+            slide_imgs = [img_abs]
+            total_imgs += 1
+            for extra_rel in find_extracted_images(b):
+                if total_imgs >= max_imgs:
+                    break
+                extra_abs = os.fspath(lecture_dir / extra_rel)
+                # One stat covers both the existence check and the cache key
+                try:
+                    extra_st = os.stat(extra_abs)
+                except OSError:
+                    continue
+                digest = _file_digest(extra_abs, extra_st.st_mtime_ns)
+                if digest in seen_digests:
+                    continue
+                seen_digests.add(digest)
+                slide_imgs.append(extra_abs)
+                total_imgs += 1
+            valid_batch_items.append((g_idx, t, b, slide_imgs))
+
         if not valid_batch_items:
-            continue
-            
+            return []
+
         # Call LLM
-        img_paths = [x[3] for x in valid_batch_items]
-        
-        prompt_lines = [
-            "Correct the markdown text for these slides using the images.",
-            "Strictly follow the order. Use delimiters '=== SLIDE N ===' where N is the slide number provided below.",
-            "IMPORTANT: Output ONLY the requested format. No conversational filler.",
-            ""
-        ]
-        
-        for i, (g_idx, t, b, _) in enumerate(valid_batch_items, start=1):
+        img_paths = [p for x in valid_batch_items for p in x[3]]
+
+        prompt_lines = []
+
+        for i, (g_idx, t, b, slide_imgs) in enumerate(valid_batch_items, start=1):
+            img_note = f"(slide screenshot + {len(slide_imgs) - 1} extracted figure(s))" if len(slide_imgs) > 1 else "(slide screenshot)"
             prompt_lines.extend([
-                f"=== SLIDE {i} INPUT ===",
+                f"=== SLIDE {i} INPUT === {img_note}",
                 f"Title: {t}",
                 f"Markdown:\n{b}",
                 ""
             ])
-            
+
+        results: List[Tuple[int, str]] = []
         try:
-            out = call_vision(
+            out = await acall_vision(
                 model=settings.vision_model,
-                system_prompt="Refine slide text from images. Keep format. Output ONLY the content for each slide.",
+                system_prompt=_VISION_FIX_SYSTEM,
                 user_text="\n".join(prompt_lines),
                 image_paths=img_paths,
-                max_output_tokens=min(8192, 1000 * len(valid_batch_items))
+                max_output_tokens=min(8192, 1000 * len(valid_batch_items)),
+                # Stream and hang up once the terminal marker arrives —
+                # anything after it would be wasted tokens.
+                stop_predicate=lambda buf: "=== END ===" in buf,
             )
 
-            # Parse
-            chunks = re.split(r"=== SLIDE (\d+) ===", out)
-            for k in range(1, len(chunks), 2):
-                num_str = chunks[k]
-                content = chunks[k+1].strip()
-                if num_str.isdigit():
-                    local_idx = int(num_str) # 1-based index in this batch
-                    
-                    if 1 <= local_idx <= len(valid_batch_items):
-                        # Map to global
-                        global_idx = valid_batch_items[local_idx-1][0]
-                        final_cleaned[global_idx] = content
-                        
+            # The terminal marker (and any partial chunk that slipped in
+            # before the stream was cancelled) must not end up in the last
+            # slide's body — everything from the marker on is dropped.
+            out = out.partition("=== END ===")[0]
+
+            # Parse: one finditer pass; each block runs from the end of its
+            # delimiter to the start of the next one.
+            matches = list(_SLIDE_DELIM_RE.finditer(out))
+            for k, m in enumerate(matches):
+                local_idx = int(m.group(1))  # 1-based index in this batch
+                end_pos = matches[k + 1].start() if k + 1 < len(matches) else len(out)
+                content = out[m.end():end_pos].strip()
+
+                if 1 <= local_idx <= len(valid_batch_items):
+                    # Map to global
+                    global_idx = valid_batch_items[local_idx-1][0]
+                    results.append((global_idx, content))
+
         except Exception as e:
              print(f"[warn] batch processing error: {e}")
 
+        return results
+
+    # Batches are independent network-bound calls — dispatch them all and
+    # bound in-flight requests with a semaphore.
+    starts = list(range(0, len(bodies), batch_size))
+    sem = asyncio.Semaphore(settings.glitch_fix_workers)
+
+    async def _bounded(start: int) -> List[Tuple[int, str]]:
+        async with sem:
+            return await _process_one_batch(start)
+
+    with tqdm(total=len(starts), desc="Vision Cleanup", unit="batch") as pbar:
+        for coro in asyncio.as_completed([_bounded(s) for s in starts]):
+            for global_idx, content in await coro:
+                final_cleaned[global_idx] = content
+            pbar.update(1)
+
     return final_cleaned
 
-def rewrite_body_md(title: str, body: str) -> str:
-    """Rewrite to fix broken math/placeholders."""
-    if not settings.rewrite_max_output_tokens:
-        return body
-        
-    prompt = (
+def batch_clean_bodies_vision(
+    lecture_dir: Path,
+    titles: List[str],
+    bodies: List[str],
+    slide_png_rels: List[str]
+) -> List[str]:
+    """Sync wrapper around abatch_clean_bodies_vision."""
+    return asyncio.run(abatch_clean_bodies_vision(lecture_dir, titles, bodies, slide_png_rels))
+
+_REWRITE_SYSTEM = "Technical editor fixing formulas. Output ONLY the fixed content."
+
+def _rewrite_prompt(title: str, body: str) -> str:
+    return (
         "Fix corrupted formulas/placeholders. Keep structure/tables/bullets.\n"
         "IMPORTANT: Output ONLY the corrected markdown. Do NOT chat.\n"
         f"Title: {title}\nMarkdown:\n{body}"
     )
+
+def rewrite_body_md(title: str, body: str) -> str:
+    """Rewrite to fix broken math/placeholders."""
+    if not settings.rewrite_max_output_tokens:
+        return body
+
     try:
         return call_text(
             model=settings.text_model,
-            system_prompt="Technical editor fixing formulas. Output ONLY the fixed content.",
-            user_prompt=prompt,
+            system_prompt=_REWRITE_SYSTEM,
+            user_prompt=_rewrite_prompt(title, body),
             temperature=0.0,
             max_output_tokens=settings.rewrite_max_output_tokens
         ).strip()
     except Exception:
         return body
+
+async def arewrite_body_md(title: str, body: str) -> str:
+    """Async counterpart of rewrite_body_md."""
+    if not settings.rewrite_max_output_tokens:
+        return body
+
+    try:
+        out = await acall_text(
+            model=settings.text_model,
+            system_prompt=_REWRITE_SYSTEM,
+            user_prompt=_rewrite_prompt(title, body),
+            temperature=0.0,
+            max_output_tokens=settings.rewrite_max_output_tokens
+        )
+        return out.strip()
+    except Exception:
+        return body
@@ -1,36 +1,205 @@
+import asyncio
 import base64
-from typing import List, Optional
+import functools
+import io
+import mmap
+import os
+from typing import Callable, Iterator, List, Optional
 from dataclasses import dataclass
 
+import httpx
+from PIL import Image
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 from scripts.config import settings
+from scripts.util import llm_cache
+
+try:
+    # SIMD-accelerated base64 (SSSE3/AVX2) — drop-in, 4-10x on large buffers
+    from pybase64 import b64encode as _b64encode
+    _HAVE_PYBASE64 = True
+except ImportError:
+    _b64encode = base64.b64encode
+    _HAVE_PYBASE64 = False
+
+# 48KB, a multiple of 3 so chunk boundaries never need base64 padding
+_B64_CHUNK = 49152
+
+
+def _b64_ascii(view) -> str:
+    """
+    base64 of a buffer as an ASCII str. With pybase64 a one-shot SIMD
+    encode is fastest; with stdlib base64, encoding in 48KB chunks into a
+    growing bytearray keeps the transient working set to one chunk plus
+    the output instead of input + full encoded copy at once.
+    """
+    if _HAVE_PYBASE64:
+        return _b64encode(view).decode("ascii")
+    mv = memoryview(view)
+    out = bytearray()
+    for start in range(0, len(mv), _B64_CHUNK):
+        out += base64.b64encode(mv[start:start + _B64_CHUNK])
+    return out.decode("ascii")
+
+# Retry only transient failures (rate limits, connection drops, 5xx) with
+# jittered exponential backoff — permanent errors (400s, auth) surface
+# immediately instead of burning three attempts on them, and the jitter
+# stops concurrent workers from retrying in lockstep.
+_TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+llm_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    retry=retry_if_exception_type(_TRANSIENT_ERRORS),
+    reraise=True,
+)
 
 def get_chat_model(model_name: str, temperature: float = 0.1, max_tokens: Optional[int] = None) -> ChatOpenAI:
     """
     Returns a configured ChatOpenAI instance.
     Uses settings from config.py
+
+    Instances are cached per (model, temperature, max_tokens) so repeated
+    calls reuse one client — and its underlying connection pool — instead
+    of paying a fresh TCP+TLS handshake per request.
     """
-    
-    api_key = settings.openrouter_api_key or settings.openai_api_key
-    
+    api_key = settings.openrouter_api_key or getattr(settings, "openai_api_key", None)
+
     if not api_key:
         raise ValueError("Missing API Key. Please set OPENROUTER_API_KEY in your .env file.")
 
+    return _cached_chat(model_name, temperature, max_tokens, _loop_key())
+
+
+def _loop_key() -> int:
+    """Identity of the running event loop (0 when none). Async transports
+    bind their keep-alive sockets to the loop that first used them, so
+    anything caching an AsyncClient must not outlive that loop — a client
+    reused across asyncio.run invocations dies with 'Event loop is
+    closed' on its first request."""
+    try:
+        return id(asyncio.get_running_loop())
+    except RuntimeError:
+        return 0
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_http_client() -> httpx.Client:
+    """One pooled connection client for every chat model: keep-alive (and
+    HTTP/2 multiplexing when h2 is installed) amortizes TLS handshakes
+    across all concurrent workers."""
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    timeout = httpx.Timeout(120.0, connect=10.0)
+    try:
+        return httpx.Client(http2=True, limits=limits, timeout=timeout)
+    except ImportError:  # h2 not installed
+        return httpx.Client(limits=limits, timeout=timeout)
+
+
+# One slot, keyed by event loop: a fresh asyncio.run gets a fresh client
+# instead of the previous loop's dead transports.
+_async_client_slot: tuple = (None, None)
+
+
+def _shared_async_http_client() -> httpx.AsyncClient:
+    """Async twin of _shared_http_client, scoped to the running event
+    loop — without it, every ainvoke path would build (and tear down) its
+    own pool per ChatOpenAI instance."""
+    global _async_client_slot
+    key = _loop_key()
+    slot_key, client = _async_client_slot
+    if client is None or slot_key != key:
+        limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        timeout = httpx.Timeout(120.0, connect=10.0)
+        try:
+            client = httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+        except ImportError:  # h2 not installed
+            client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        _async_client_slot = (key, client)
+    return client
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_chat(model_name: str, temperature: float, max_tokens: Optional[int], loop_key: int) -> ChatOpenAI:
+    # loop_key only partitions the cache: ChatOpenAI instances hold the
+    # loop-bound async client, so they must be rebuilt under a new loop.
     return ChatOpenAI(
         model=model_name,
         temperature=temperature,
         max_tokens=max_tokens,
-        api_key=api_key,
+        api_key=settings.openrouter_api_key or getattr(settings, "openai_api_key", None),
         base_url=settings.openai_base_url,
+        http_client=_shared_http_client(),
+        http_async_client=_shared_async_http_client(),
         default_headers={
             "HTTP-Referer": "https://github.com/your-repo/course-summarizer",
             "X-Title": "Course Summarizer",
         }
     )
 
-def img_to_data_url(path: str) -> str:
+def img_to_data_url(path: str, max_side: Optional[int] = None, jpeg_quality: Optional[int] = None) -> str:
+    """
+    Encodes an image as a base64 data URL.
+    Images larger than max_side are downscaled and re-encoded as JPEG before
+    upload — full-resolution slide PNGs waste tokens and bandwidth on the
+    vision API without improving output quality.
+
+    Results are cached on (path, mtime, size) so the same slide image is
+    only read and encoded once across retries and batches.
+    """
+    if max_side is None:
+        max_side = settings.vision_max_side
+    if jpeg_quality is None:
+        jpeg_quality = settings.vision_jpeg_quality
+
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    return _encode_image(real, st.st_mtime_ns, st.st_size, max_side, jpeg_quality)
+
+
+def clear_image_cache() -> None:
+    """Drops cached data URLs (useful in long-lived processes)."""
+    _encode_image.cache_clear()
+
+
+@functools.lru_cache(maxsize=512)
+def _encode_image(path: str, mtime_ns: int, size: int, max_side: int, jpeg_quality: int) -> str:
+    if max_side:
+        # Downscaled JPEGs persist in a sidecar dir versioned by the
+        # resize parameters (e.g. slides_png/.v1280q80/), so reruns of an
+        # unchanged deck skip the Pillow decode+resize entirely.
+        cache_dir = os.path.join(os.path.dirname(path), f".v{max_side}q{jpeg_quality}")
+        cache_path = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + ".jpg")
+        try:
+            if os.stat(cache_path).st_mtime_ns >= mtime_ns:
+                with open(cache_path, "rb") as f:
+                    return f"data:image/jpeg;base64,{_b64_ascii(f.read())}"
+        except OSError:
+            pass
+        try:
+            with Image.open(path) as im:
+                if max(im.size) > max_side:
+                    im.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+                    if im.mode != "RGB":
+                        im = im.convert("RGB")
+                    buf = io.BytesIO()
+                    im.save(buf, format="JPEG", quality=jpeg_quality)
+                    try:
+                        os.makedirs(cache_dir, exist_ok=True)
+                        tmp = cache_path + ".tmp"
+                        with open(tmp, "wb") as f:
+                            f.write(buf.getbuffer())
+                        os.replace(tmp, cache_path)
+                    except OSError:
+                        pass  # cache is best-effort; the encode still works
+                    b64 = _b64_ascii(buf.getbuffer())
+                    return f"data:image/jpeg;base64,{b64}"
+        except Exception:
+            pass  # Not an image Pillow can read — fall through to raw bytes
+
     ext = path.lower().split(".")[-1]
     if ext in ("jpg", "jpeg"):
         mime = "image/jpeg"
@@ -39,10 +208,18 @@ def img_to_data_url(path: str) -> str:
     else:
         mime = "application/octet-stream"
 
+    # mmap the file so the encode reads straight from the page cache instead
+    # of holding a full bytes copy alongside the encoded output. base64 is
+    # pure ASCII, so decode("ascii") skips UTF-8 validation.
     with open(path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
+        if size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                b64 = _b64_ascii(mm)
+        else:
+            b64 = ""
     return f"data:{mime};base64,{b64}"
 
+@llm_retry
 def call_text(
     system_prompt: str,
     user_prompt: str,
@@ -51,37 +228,208 @@ def call_text(
     max_output_tokens: Optional[int] = None,
 ) -> str:
     """Synchronous text-only call."""
+    cache_key = None
+    if llm_cache.enabled(temperature):
+        cache_key = llm_cache.make_key(model, system_prompt, user_prompt, temperature, max_output_tokens)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     chat = get_chat_model(model, temperature, max_output_tokens)
     messages = [
-        SystemMessage(content=system_prompt),
+        _system_message(system_prompt, model),
         HumanMessage(content=user_prompt),
     ]
     response = chat.invoke(messages)
-    return str(response.content)
+    out = str(response.content)
+    if cache_key is not None:
+        llm_cache.put(cache_key, out)
+    return out
 
-def call_vision(
+def call_text_stream(
     system_prompt: str,
-    user_text: str,
-    image_paths: List[str],
+    user_prompt: str,
     model: str,
     temperature: float = 0.15,
-    max_output_tokens: Optional[int] = 400,
+    max_output_tokens: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Streaming variant of call_text: yields response chunks as they arrive
+    so callers can overlap generation with their own writes. A cache hit
+    is yielded as a single chunk.
+    """
+    cache_key = None
+    if llm_cache.enabled(temperature):
+        cache_key = llm_cache.make_key(model, system_prompt, user_prompt, temperature, max_output_tokens)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    chat = get_chat_model(model, temperature, max_output_tokens)
+    messages = [
+        _system_message(system_prompt, model),
+        HumanMessage(content=user_prompt),
+    ]
+    parts: List[str] = []
+    for chunk in chat.stream(messages):
+        text = str(chunk.content)
+        if text:
+            parts.append(text)
+            yield text
+    if cache_key is not None:
+        llm_cache.put(cache_key, "".join(parts))
+
+@llm_retry
+async def acall_text(
+    system_prompt: str,
+    user_prompt: str,
+    model: str,
+    temperature: float = 0.15,
+    max_output_tokens: Optional[int] = None,
 ) -> str:
-    """Synchronous vision call."""
+    """Async text-only call (for concurrent fan-out via asyncio.gather)."""
+    cache_key = None
+    if llm_cache.enabled(temperature):
+        cache_key = llm_cache.make_key(model, system_prompt, user_prompt, temperature, max_output_tokens)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     chat = get_chat_model(model, temperature, max_output_tokens)
-    
+    messages = [
+        _system_message(system_prompt, model),
+        HumanMessage(content=user_prompt),
+    ]
+    response = await chat.ainvoke(messages)
+    out = str(response.content)
+    if cache_key is not None:
+        llm_cache.put(cache_key, out)
+    return out
+
+def _system_message(system_prompt: str, model: str) -> SystemMessage:
+    """
+    System message with provider prompt caching enabled where supported.
+    OpenAI caches shared prefixes automatically; Anthropic models (routed
+    via OpenRouter) need an explicit ephemeral cache_control marker. The
+    system prompts are static per call site, so marking them lets repeat
+    calls skip prefill on the shared prefix.
+    """
+    name = model.lower()
+    if "anthropic" in name or "claude" in name:
+        return SystemMessage(content=[{
+            "type": "text",
+            "text": system_prompt,
+            "cache_control": {"type": "ephemeral"},
+        }])
+    return SystemMessage(content=system_prompt)
+
+def build_vision_messages(system_prompt: str, user_text: str, image_paths: List[str], model: str = "") -> list:
+    """
+    Assembles the message list for a vision call, including all image
+    encoding. Building once and reusing across retries or fallback models
+    avoids re-reading and re-encoding every image per attempt.
+    """
     content: List[dict] = [{"type": "text", "text": user_text}]
     for p in image_paths:
         data_url = img_to_data_url(p)
         content.append({
-            "type": "image_url", 
-            "image_url": {"url": data_url}
+            "type": "image_url",
+            "image_url": {"url": data_url, "detail": settings.vision_detail}
         })
-        
-    messages = [
-        SystemMessage(content=system_prompt),
+
+    return [
+        _system_message(system_prompt, model),
         HumanMessage(content=content),
     ]
-    
+
+@llm_retry
+def call_vision(
+    system_prompt: str,
+    user_text: str,
+    image_paths: List[str],
+    model: str,
+    temperature: float = 0.15,
+    max_output_tokens: Optional[int] = 400,
+    stop_predicate: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """
+    Synchronous vision call.
+
+    When stop_predicate is given, the response is streamed and the
+    connection is closed as soon as the predicate returns True on the
+    accumulated text — tokens the model would generate past a known
+    terminal delimiter are never paid for.
+    """
+    cache_key = None
+    if llm_cache.enabled(temperature):
+        cache_key = llm_cache.make_key(model, system_prompt, user_text, temperature, max_output_tokens, image_paths)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    chat = get_chat_model(model, temperature, max_output_tokens)
+    messages = build_vision_messages(system_prompt, user_text, image_paths, model)
+
+    if stop_predicate is not None:
+        buf = ""
+        for chunk in chat.stream(messages):
+            text = str(chunk.content)
+            if not text:
+                continue
+            buf += text
+            if stop_predicate(buf):
+                break
+        if cache_key is not None:
+            llm_cache.put(cache_key, buf)
+        return buf
+
     response = chat.invoke(messages)
-    return str(response.content)
+    out = str(response.content)
+    if cache_key is not None:
+        llm_cache.put(cache_key, out)
+    return out
+
+@llm_retry
+async def acall_vision(
+    system_prompt: str,
+    user_text: str,
+    image_paths: List[str],
+    model: str,
+    temperature: float = 0.15,
+    max_output_tokens: Optional[int] = 400,
+    stop_predicate: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """Async vision call. stop_predicate behaves as in call_vision."""
+    cache_key = None
+    if llm_cache.enabled(temperature):
+        cache_key = llm_cache.make_key(model, system_prompt, user_text, temperature, max_output_tokens, image_paths)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    chat = get_chat_model(model, temperature, max_output_tokens)
+    # Image read+resize+base64 is blocking CPU/disk work; running it on a
+    # worker thread keeps the event loop free, so one batch's encoding
+    # pipelines behind another batch's in-flight HTTP instead of
+    # serializing every encode on the loop.
+    messages = await asyncio.to_thread(build_vision_messages, system_prompt, user_text, image_paths, model)
+
+    if stop_predicate is not None:
+        buf = ""
+        async for chunk in chat.astream(messages):
+            text = str(chunk.content)
+            if not text:
+                continue
+            buf += text
+            if stop_predicate(buf):
+                break
+        if cache_key is not None:
+            llm_cache.put(cache_key, buf)
+        return buf
+
+    response = await chat.ainvoke(messages)
+    out = str(response.content)
+    if cache_key is not None:
+        llm_cache.put(cache_key, out)
+    return out
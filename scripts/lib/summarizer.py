@@ -1,7 +1,11 @@
-import time
+import hashlib
+import os
+import re
 from pathlib import Path
+from typing import List
 from scripts.config import settings
-from scripts.lib.llm import call_text
+from scripts.lib.llm import acall_text, call_text, call_text_stream, llm_retry
+from scripts.util import jsonio, token_budget
 
 SYSTEM_PROMPT = """You are an expert academic synthesizer.
 You summarize lecture slides into exam-grade LaTeX notes.
@@ -13,55 +17,231 @@ You summarize lecture slides into exam-grade LaTeX notes.
 - Prioritize using `extracted_images` over `slide_png` if available.
 """
 
-MAX_RETRIES = 3
+def _slides_json_capped(slides: list, budget: int = None) -> str:
+    """
+    Compact JSON for the prompt, encoded slide-by-slide under a token
+    budget: an oversized deck stops at the cap instead of serializing
+    content the model's context could never carry, and tokens — not a
+    character slice — are what the provider actually counts. A marker
+    slide tells the model how much was dropped, and the emitted array
+    stays valid JSON (no mid-object truncation).
+    """
+    if budget is None:
+        budget = settings.summary_token_budget
+    pieces = [jsonio.dumps_bytes(s, indent=False).decode("utf-8") for s in slides]
+    kept = token_budget.cap_blocks(pieces, settings.text_model, budget)
+    dropped = len(pieces) - len(kept)
+    if dropped:
+        print(f"[warn] Slides JSON capped at {budget} tokens; {dropped} slides omitted from the prompt.")
+        kept.append(f'"...<truncated {dropped} slides>"')
+    return "[" + ",".join(kept) + "]"
 
-def summarize_lecture(
-    lecture_dir: Path,
-    slide_blocks_file: Path,
-    system_prompt_override: str = None
-) -> None:
-    """Summarizes a whole lecture into lecture_notes.tex."""
-    
+def _build_prompt(slide_blocks_file: Path) -> str:
     if not slide_blocks_file.exists():
         raise RuntimeError(f"Missing slides.json at {slide_blocks_file}")
-        
-    slides_content = slide_blocks_file.read_text(encoding="utf-8")
-    
+
+    # The build re-serializes and tokenizes every slide, which costs
+    # hundreds of ms on big decks — but it's a pure function of the
+    # slides.json bytes (plus the model/budget that drive the cap), so
+    # the finished prompt is cached beside the lecture keyed on that
+    # hash. A changed deck hashes to a new entry; stale ones are simply
+    # never read again.
+    raw = slide_blocks_file.read_bytes()
+    h = hashlib.sha256(raw)
+    h.update(f"{settings.text_model}:{settings.summary_token_budget}".encode("utf-8"))
+    cache_path = slide_blocks_file.parent / ".prompt_cache" / f"{h.hexdigest()[:32]}.txt"
+    try:
+        return cache_path.read_text(encoding="utf-8")
+    except OSError:
+        pass
+
+    # Parse and re-serialize compact: orjson does both in C, and dropping
+    # the on-disk indentation shrinks the prompt.
+    slides = jsonio.loads(raw)
+    if isinstance(slides, list):
+        slides_content = _slides_json_capped(slides)
+    else:
+        slides_content = jsonio.dumps_bytes(slides, indent=False).decode("utf-8")
+
+    # Instructions ahead of the variable JSON: the static prefix (system
+    # prompt + these lines) stays token-identical across lectures, which
+    # is what provider prefix caching keys on. Don't reorder.
     prompt = f"""
     Here is the content of a lecture (JSON format with slide text and image paths).
     Summarize this into a single cohesive LaTeX document (only body, no preamble).
-    
+
     Content:
     {slides_content}
     """
-    
+
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        tmp = cache_path.with_suffix(".txt.tmp")
+        tmp.write_bytes(prompt.encode("utf-8"))
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # cache is best-effort
+    return prompt
+
+def _strip_fences(out: str) -> str:
+    if "```latex" in out:
+        out = out.split("```latex")[1].split("```")[0].strip()
+    elif "```" in out:
+        out = out.split("```")[1].split("```")[0].strip()
+    return out
+
+def summarize_lecture(
+    lecture_dir: Path,
+    slide_blocks_file: Path,
+    system_prompt_override: str = None
+) -> None:
+    """Summarizes a whole lecture into lecture_notes.tex."""
+    prompt = _build_prompt(slide_blocks_file)
     sys_prompt = system_prompt_override or SYSTEM_PROMPT
-    
+
     print(f"[info] Summarizing lecture {lecture_dir.name}...")
     
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            out = call_text(
+    tex_path = lecture_dir / "lecture_notes.tex"
+    partial_path = tex_path.with_suffix(".tex.partial")
+
+    # llm_retry retries only transient errors (429s, connection drops, 5xx)
+    # with jittered backoff; a 400 fails once and surfaces immediately
+    # instead of eating three blind 2**n sleeps.
+    @llm_retry
+    def _generate() -> str:
+        # Stream chunks to a .partial file as they arrive — generation
+        # overlaps disk writes and progress is visible on disk. Fence
+        # stripping needs the whole text, so it runs once at the end
+        # before the atomic rename.
+        parts = []
+        with open(partial_path, "w", encoding="utf-8") as f:
+            for chunk in call_text_stream(
                 model=settings.text_model,
                 system_prompt=sys_prompt,
                 user_prompt=prompt,
                 temperature=0.1,
                 max_output_tokens=settings.rewrite_max_output_tokens * 10
-            )
-            
-            if "```latex" in out:
-                out = out.split("```latex")[1].split("```")[0].strip()
-            elif "```" in out:
-                out = out.split("```")[1].split("```")[0].strip()
-                
-            (lecture_dir / "lecture_notes.tex").write_text(out, encoding="utf-8")
-            print(f"[ok] Wrote lecture_notes.tex")
-            return
-            
-        except Exception as e:
-            if attempt < MAX_RETRIES:
-                wait = 2 ** attempt
-                print(f"[warn] Summarization attempt {attempt}/{MAX_RETRIES} failed: {e}. Retrying in {wait}s...")
-                time.sleep(wait)
-            else:
-                print(f"[error] Summarization failed after {MAX_RETRIES} attempts: {e}")
+            ):
+                f.write(chunk)
+                parts.append(chunk)
+        return "".join(parts)
+
+    try:
+        out = _generate()
+    except Exception as e:
+        print(f"[error] Summarization failed: {e}")
+        return
+
+    out = _strip_fences(out)
+
+    partial_path.write_bytes(out.encode("utf-8"))
+    os.replace(partial_path, tex_path)
+    print(f"[ok] Wrote lecture_notes.tex")
+
+# Per-lecture LaTeX block header in a batched chapter response. Lecture
+# names are file stems and routinely contain spaces, so the capture is
+# lazy-any up to the closing marker rather than \S+.
+_LATEX_BLOCK_RE = re.compile(r"(?m)^=== LATEX (.+?) ===[ \t]*$")
+
+def summarize_chapter(out_root: Path, lecture_names: List[str]) -> None:
+    """
+    Summarizes all lectures of a chapter in one LLM call instead of one
+    call per lecture: request overhead and the system-prompt prefill are
+    paid once per chapter, and the shared static system prompt lets the
+    provider's prefix cache carry across chapters. Each lecture's slides
+    go in under <<<LECTURE name>>> sentinels; the response is split on
+    '=== LATEX <name> ===' headers into per-lecture .tex files. Lectures
+    the batch response misses fall back to single-lecture summarization.
+    """
+    names = [n for n in lecture_names if (out_root / n / "slides.json").exists()]
+    if not names:
+        return
+
+    # Split the summary budget across the chapter so a long lecture
+    # can't crowd its siblings out of the prompt entirely.
+    per_lecture_budget = max(settings.summary_token_budget // len(names), 2000)
+    sections = []
+    for name in names:
+        slides = jsonio.read_json(out_root / name / "slides.json")
+        blob = _slides_json_capped(slides, per_lecture_budget) if isinstance(slides, list) \
+            else jsonio.dumps_bytes(slides, indent=False).decode("utf-8")
+        sections.append(f"<<<LECTURE {name}>>>\n{blob}\n<<<END>>>")
+
+    prompt = f"""
+    Here are {len(names)} lectures from one chapter (JSON slides per lecture,
+    delimited by <<<LECTURE name>>> ... <<<END>>>).
+    Summarize EACH lecture into its own cohesive LaTeX document (only body, no preamble).
+    For each lecture output exactly one block:
+    === LATEX <lecture name> ===
+    <latex body>
+
+    {chr(10).join(sections)}
+    """
+
+    print(f"[info] Summarizing chapter batch: {', '.join(names)}...")
+    try:
+        out = call_text(
+            model=settings.text_model,
+            system_prompt=SYSTEM_PROMPT,
+            user_prompt=prompt,
+            temperature=0.1,
+            max_output_tokens=settings.rewrite_max_output_tokens * 10 * len(names)
+        )
+    except Exception as e:
+        print(f"[error] Chapter summarization failed: {e}")
+        out = ""
+
+    bodies = {}
+    matches = list(_LATEX_BLOCK_RE.finditer(out))
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(out)
+        bodies[m.group(1)] = _strip_fences(out[m.end():end].strip())
+
+    for name in names:
+        body = bodies.get(name)
+        if not body:
+            print(f"[warn] No block for {name} in chapter response; summarizing individually.")
+            summarize_lecture(out_root / name, out_root / name / "slides.json")
+            continue
+        tex_path = out_root / name / "lecture_notes.tex"
+        partial_path = tex_path.with_suffix(".tex.partial")
+        partial_path.write_bytes(body.encode("utf-8"))
+        os.replace(partial_path, tex_path)
+        print(f"[ok] Wrote {tex_path}")
+
+async def asummarize_lecture(
+    lecture_dir: Path,
+    slide_blocks_file: Path,
+    system_prompt_override: str = None
+) -> None:
+    """
+    Async counterpart of summarize_lecture for pipelines already on the
+    event loop: N lectures' summaries overlap their generation latency,
+    and each coroutine writes its .tex as soon as its response lands.
+    acall_text already carries the transient-error retry policy.
+    """
+    prompt = _build_prompt(slide_blocks_file)
+    sys_prompt = system_prompt_override or SYSTEM_PROMPT
+
+    print(f"[info] Summarizing lecture {lecture_dir.name}...")
+
+    tex_path = lecture_dir / "lecture_notes.tex"
+    partial_path = tex_path.with_suffix(".tex.partial")
+
+    try:
+        out = await acall_text(
+            model=settings.text_model,
+            system_prompt=sys_prompt,
+            user_prompt=prompt,
+            temperature=0.1,
+            max_output_tokens=settings.rewrite_max_output_tokens * 10
+        )
+    except Exception as e:
+        print(f"[error] Summarization failed: {e}")
+        return
+
+    out = _strip_fences(out)
+
+    partial_path.write_bytes(out.encode("utf-8"))
+    os.replace(partial_path, tex_path)
+    print(f"[ok] Wrote lecture_notes.tex")
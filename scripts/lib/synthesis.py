@@ -1,10 +1,16 @@
-import json
+import functools
+import io
+import mmap
+import os
 import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Tuple, Dict, Any
 
 from scripts.config import settings
-from scripts.lib.llm import call_text
+from scripts.lib.llm import call_text, call_text_stream, llm_retry
+from scripts.util import jsonio, token_budget
 
 SYSTEM_PROMPT = """You synthesize full academic course notes in LaTeX.
 Strict notation consistency. Keep math correct.
@@ -12,18 +18,106 @@ Include Global Glossary.
 Avoid duplication.
 """
 
+# Static text first, variable payloads last: provider-side prefix
+# caching only matches identical token prefixes, so the instructions and
+# output spec must not sit behind per-course JSON. Don't reorder.
 PROMPT_TEMPLATE = """Synthesize these lecture notes into a coherent course.
+
+Output EXACTLY:
+=== LATEX ===
+<latex body>
+
 Structure:
 {structure_json}
 
 Content:
 {notes}
-
-Output EXACTLY:
-=== LATEX ===
-<latex body>
 """
 
+# Bytes pattern over an mmap: the scan works on a zero-copy page-cache
+# view of slides.md (no full str materialization) and only matched titles
+# are decoded.
+_TITLE_RE = re.compile(rb"(?m)^#{1,3}[ \t]*(.+?)[ \t\r]*$")
+
+# One alternation instead of three separate patterns: a title is scanned
+# once however the chapter number is spelled.
+_CH_RE = re.compile(r"\bchapter\s*(\d+)\b|\bch\.?\s*(\d+)\b|\bch(\d+)\b", re.I)
+_CH_STRIP_RE = re.compile(r"\bch(?:apter|\.?)?\s*\d+\b", re.I)
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+# {img/...} and {slides_png/...} references inside lecture .tex bodies
+# are rewritten by prefix only — plain str.replace runs the whole scan in
+# C with no match objects, which beats a regex pass on multi-MB bodies.
+_TEX_IMG_PREFIXES = ("{img/", "{slides_png/")
+
+
+# Fenced JSON body in an LLM response (``` or ```json)
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*\})\s*```", re.S)
+
+def extract_chapter(s: str) -> int | None:
+    """Chapter number mentioned in a folder name or slide title, if any."""
+    m = _CH_RE.search(s or "")
+    if m:
+        return int(next(g for g in m.groups() if g))
+    return None
+
+def norm_title(s: str) -> str:
+    """Lowercased title with chapter markers and punctuation stripped."""
+    s = _CH_STRIP_RE.sub("", s.lower())
+    return _NON_ALNUM_RE.sub(" ", s).strip()
+
+def _fallback_structure(out_root: Path, lectures: List[str]) -> Dict[str, Any]:
+    """
+    Deterministic structure when LLM inference fails: group lectures by the
+    chapter number in their folder name, or failing that the dominant
+    chapter number across their slide titles (Counter aggregation).
+    Lectures with no recognizable chapter land in a trailing flat part.
+    """
+    by_chapter: Dict[int, List[str]] = {}
+    unmatched: List[str] = []
+    for name in lectures:
+        ch = extract_chapter(name)
+        if ch is None:
+            counts = Counter(
+                c for t in read_titles_from_slides_md(out_root / name / "slides.md", limit=50)
+                if (c := extract_chapter(t)) is not None
+            )
+            if counts:
+                ch = counts.most_common(1)[0][0]
+        if ch is None:
+            unmatched.append(name)
+        else:
+            by_chapter.setdefault(ch, []).append(name)
+
+    chapters: List[Dict[str, Any]] = [
+        {"title": f"Chapter {ch}", "parts": [{"title": f"Chapter {ch}", "files": files}]}
+        for ch, files in sorted(by_chapter.items())
+    ]
+    if unmatched or not chapters:
+        chapters.append({"title": "Course Modules", "parts": [{"title": "All Lectures", "files": unmatched or lectures}]})
+    return {"chapters": chapters}
+
+@functools.lru_cache(maxsize=4096)
+def _titles(path_str: str, mtime_ns: int) -> Tuple[str, ...]:
+    with open(path_str, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:  # zero-length files can't be mmapped
+            return ()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return tuple(m.group(1).decode("utf-8", "replace") for m in _TITLE_RE.finditer(mm))
+
+def read_titles_from_slides_md(md_path: Path, limit: int = 8) -> List[str]:
+    """
+    First slide titles of a lecture — cheap context for structure
+    inference. A single compiled MULTILINE findall pass; no per-line
+    Python loop. Parsed titles are memoized on (path, mtime) so the
+    structure prompt and the chapter fallback share one read per file.
+    """
+    try:
+        titles = _titles(str(md_path), md_path.stat().st_mtime_ns)
+    except OSError:
+        return []
+    return list(titles[:limit])
+
 def infer_structure(out_root: Path) -> None:
     """
     Scans out_root for Lecture directories and infers a course structure (Chapters/Parts).
@@ -39,12 +133,22 @@ def infer_structure(out_root: Path) -> None:
         print("[warn] No processed lectures found to infer structure from.")
         return
 
-    # Ask LLM to optimize structure
-    
+    # Ask LLM to optimize structure. Slide titles give it real content to
+    # group by instead of just folder names. The per-lecture reads are
+    # independent and I/O-bound, so fan them out instead of walking the
+    # course serially.
+    with ThreadPoolExecutor(max_workers=min(16, len(lectures))) as ex:
+        lecture_info = dict(zip(lectures, ex.map(
+            lambda name: read_titles_from_slides_md(out_root / name / "slides.md"),
+            lectures
+        )))
+
+    # Static instructions and format spec up front, variable folder JSON
+    # at the tail — keeps the cacheable prompt prefix identical between
+    # runs and courses.
     prompt = f"""
     Organize these lecture folders into a logical course structure (Chapters -> Parts -> Files).
-    Folders: {json.dumps(lectures)}
-    
+
     Return JSON:
     {{
       "chapters": [
@@ -56,6 +160,8 @@ def infer_structure(out_root: Path) -> None:
         }}
       ]
     }}
+
+    Folders (with their first slide titles): {jsonio.dumps_bytes(lecture_info, indent=False).decode("utf-8")}
     """
     
     try:
@@ -66,24 +172,21 @@ def infer_structure(out_root: Path) -> None:
             temperature=0.0,
             max_output_tokens=2000
         )
-        # simplistic json extraction
-        if "```json" in out:
-            out = out.split("```json")[1].split("```")[0].strip()
-        elif "```" in out:
-            out = out.split("```")[1].split("```")[0].strip()
-            
-        structure = json.loads(out)
+        # One compiled pass extracts the fenced JSON body (if any) instead
+        # of chained split() copies of the whole response.
+        m = _JSON_FENCE_RE.search(out)
+        structure = jsonio.loads(m.group(1) if m else out)
         
         synth_dir = out_root / "synthesized"
         synth_dir.mkdir(parents=True, exist_ok=True)
-        (synth_dir / "structure.json").write_text(json.dumps(structure, indent=2), encoding="utf-8")
+        jsonio.write_json(synth_dir / "structure.json", structure)
         print(f"[ok] Structure inferred: {len(structure.get('chapters', []))} chapters.")
         
     except Exception as e:
         print(f"[error] Structure inference failed: {e}")
-        # Fallback: linear
-        structure = {"chapters": [{"title": "Course Modules", "parts": [{"title": "All Lectures", "files": lectures}]}]}
-        (out_root / "synthesized" / "structure.json").write_text(json.dumps(structure, indent=2), encoding="utf-8")
+        # Fallback: group by chapter numbers instead of one flat list
+        structure = _fallback_structure(out_root, lectures)
+        jsonio.write_json(out_root / "synthesized" / "structure.json", structure)
 
 
 def synthesize_course(out_root: Path) -> None:
@@ -97,7 +200,7 @@ def synthesize_course(out_root: Path) -> None:
         print("[error] No lecture_notes.tex found — nothing to synthesize.")
         return
         
-    structure = json.loads(struct_path.read_text(encoding="utf-8"))
+    structure = jsonio.read_json(struct_path)
     
     # Gather Content
     ordered_files = []
@@ -105,55 +208,126 @@ def synthesize_course(out_root: Path) -> None:
         for part in ch.get("parts", []):
             ordered_files.extend(part.get("files", []))
             
-    # Read and rewrite paths
-    chunks = []
+    # Prefetch every lecture's .tex concurrently — the reads are
+    # independent and latency-bound (worst on network-mounted out_root),
+    # so N serial read latencies collapse to roughly one.
+    def _read_tex(name: str):
+        try:
+            # read_bytes is one GIL-releasing read of the whole file;
+            # decoding happens once on the result instead of through a
+            # TextIOWrapper.
+            return (out_root / name / "lecture_notes.tex").read_bytes().decode("utf-8")
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(16, max(len(ordered_files), 1))) as ex:
+        contents = dict(zip(ordered_files, ex.map(_read_tex, ordered_files)))
+
+    # Assemble into one buffer under a token budget — tokens are what the
+    # model's context actually counts, so the cap lands where the
+    # provider's limit does rather than at an approximate character
+    # distance. Lectures past the budget are never rewritten or encoded.
+    buf = io.StringIO()
+    remaining = settings.synthesis_token_budget
     for lec_name in ordered_files:
-        p = out_root / lec_name / "lecture_notes.tex"
-        if p.exists():
-            content = p.read_text(encoding="utf-8")
-            # Rewrite image paths to be relative to the synthesized directory
-            
-            def repl(m):
-                # match {img/...}
-                # group(1) = img/ or slides_png/
-                # group(2) = rest
-                path_prefix = m.group(1)
-                rest = m.group(2)
-                return f"{{../{lec_name}/{path_prefix}{rest}"
-            
-            content = re.sub(r"\{(img/)([^}]+)", repl, content)
-            content = re.sub(r"\{(slides_png/)([^}]+)", repl, content)
-            
-            chunks.append(f"% SOURCE: {lec_name}\n{content}")
-            
-    full_notes = "\n\n".join(chunks)
-    
+        if remaining <= 0:
+            print(f"[warn] Token budget reached; remaining lectures truncated from the synthesis prompt.")
+            break
+        content = contents.get(lec_name)
+        if content is not None:
+            # Rewrite image paths to be relative to the synthesized
+            # directory. The rewrite only prepends ../<lecture>/ to two
+            # fixed prefixes, so each is a single str.replace, guarded by
+            # a substring check to skip image-free lectures entirely.
+            for prefix in _TEX_IMG_PREFIXES:
+                if prefix in content:
+                    content = content.replace(prefix, f"{{../{lec_name}/{prefix[1:]}")
+
+            # Write header, body and separator straight into the buffer —
+            # no concatenated per-lecture copy that exists only to be
+            # written (and possibly sliced) once.
+            for part in (f"% SOURCE: {lec_name}\n", content, "\n\n"):
+                if remaining <= 0:
+                    break
+                n = token_budget.count_tokens(part, settings.text_model)
+                if n <= remaining:
+                    buf.write(part)
+                else:
+                    # Cut the boundary lecture on a token edge
+                    buf.write(token_budget.truncate(part, settings.text_model, remaining))
+                remaining -= n
+
     # Call LLM
     print("[info] Synthesizing final course notes...")
-    valid_json = json.dumps(structure)
-    
-    # Truncate if massive
+    valid_json = jsonio.dumps_bytes(structure, indent=False).decode("utf-8")
+
     prompt = PROMPT_TEMPLATE.format(
         structure_json=valid_json,
-        notes=full_notes[:400000] # Cap chars
+        notes=buf.getvalue()
     )
     
+    tex_path = synth_dir / "course_notes.tex"
+    partial_path = tex_path.with_suffix(".tex.partial")
+
     try:
-        out = call_text(
-            model=settings.text_model,
-            system_prompt=SYSTEM_PROMPT,
-            user_prompt=prompt,
-            temperature=0.1,
-            max_output_tokens=settings.synthesis_max_output_tokens
-        )
-        
-        if "=== LATEX ===" in out:
-            out = out.split("=== LATEX ===")[1].strip()
-        if "```latex" in out: # cleanup
-            out = out.split("```latex")[1].split("```")[0].strip()
-            
-        (synth_dir / "course_notes.tex").write_text(out, encoding="utf-8")
-        print(f"[ok] Wrote {synth_dir / 'course_notes.tex'}")
-        
+        if settings.use_batch_api:
+            # Offline path: half-price batched completion — fine for the
+            # overnight process command where latency doesn't matter.
+            from scripts.lib import batch_client
+            results = batch_client.submit_batch([batch_client.build_request(
+                custom_id="course_synthesis",
+                model=settings.text_model,
+                system_prompt=SYSTEM_PROMPT,
+                user_prompt=prompt,
+                temperature=0.1,
+                max_output_tokens=settings.synthesis_max_output_tokens,
+            )])
+            out = results["course_synthesis"]
+        else:
+            # Stream to disk: writing starts at the first token instead of
+            # after the last one, and chunks are flushed in ~4KB batches so
+            # a half-megabyte response never needs to be the only copy in
+            # RAM before anything hits the file. llm_retry wraps the whole
+            # consumption (a stream can die mid-read, not just on connect)
+            # and each attempt reopens the .partial file from scratch.
+            @llm_retry
+            def _generate() -> str:
+                parts: List[str] = []
+                pending: List[str] = []
+                pending_len = 0
+                with open(partial_path, "w", encoding="utf-8") as f:
+                    for chunk in call_text_stream(
+                        model=settings.text_model,
+                        system_prompt=SYSTEM_PROMPT,
+                        user_prompt=prompt,
+                        temperature=0.1,
+                        max_output_tokens=settings.synthesis_max_output_tokens
+                    ):
+                        parts.append(chunk)
+                        pending.append(chunk)
+                        pending_len += len(chunk)
+                        if pending_len >= 4096:
+                            f.write("".join(pending))
+                            pending.clear()
+                            pending_len = 0
+                    if pending:
+                        f.write("".join(pending))
+                return "".join(parts)
+
+            out = _generate()
+
+        # partition returns three slices in one C-level scan — no list of
+        # fragments like split, which matters on multi-MB LaTeX output.
+        _, sep, tail = out.partition("=== LATEX ===")
+        if sep:
+            out = tail.strip()
+        _, sep, tail = out.partition("```latex")  # cleanup
+        if sep:
+            out = tail.partition("```")[0].strip()
+
+        partial_path.write_bytes(out.encode("utf-8"))
+        os.replace(partial_path, tex_path)
+        print(f"[ok] Wrote {tex_path}")
+
     except Exception as e:
         print(f"[error] Synthesis failed: {e}")
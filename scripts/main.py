@@ -1,21 +1,34 @@
 import argparse
+import asyncio
+import os
+import shutil
 import sys
-from pathlib import Path
+import tempfile
+import threading
 from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from scripts.config import settings
-from scripts.lib.pdf_tools import pptx_to_pdf, pdf_to_pngs, latex_to_pdf
-from scripts.lib.content_parser import parse_slides_md, find_extracted_images, clean_body_md, rewrite_body_md, batch_clean_bodies_vision, SlideBlock
-from scripts.lib.summarizer import summarize_lecture
+from scripts.lib.pdf_tools import pptx_batch_to_pdf, pptx_to_pngs, pdf_to_pngs, latex_to_pdf
+from scripts.lib.content_parser import parse_slides_md, find_extracted_images, needs_vision_fix, abatch_clean_rewrite, abatch_clean_bodies_vision, SlideBlock
+from scripts.lib.summarizer import asummarize_lecture, summarize_chapter
 from scripts.lib.synthesis import synthesize_course, infer_structure
 from scripts.util import pdf_utils
-import json
+from scripts.util import jsonio
 from dataclasses import asdict
 from tqdm import tqdm
 
-def process_single_lecture(input_file: Path):
+# Serializes the in-process pptx2md conversions (see _extract_md)
+_pptx2md_lock = threading.Lock()
+
+async def process_single_lecture(input_file: Path, prerendered_pdf: Path = None, summarize: bool = True):
     """
     Full pipeline for one lecture file (PPTX or PDF).
+
+    Runs as a coroutine: the LLM-bound stages await the async call paths
+    directly, and the subprocess/CPU stages hop to worker threads via
+    asyncio.to_thread so many lectures share one event loop instead of
+    each blocking a pool thread for its whole lifetime.
     """
     print(f"[start] {input_file.name}")
     
@@ -29,26 +42,49 @@ def process_single_lecture(input_file: Path):
         
         # 1. Conversion / Extraction
         if input_file.suffix.lower() == ".pptx":
-            # PPTX -> PDF (temp) -> PNGs
-            tmp_pdf = out_dir / "_temp.pdf"
-            pptx_to_pdf(input_file, tmp_pdf)
-            pdf_to_pngs(tmp_pdf, slides_png_dir, dpi=settings.dpi)
-            
-            # PPTX -> Markdown
-            import subprocess
-            cmd = ["pptx2md", str(input_file), "-o", str(out_dir / "slides.md"), "--disable-image"] 
-            subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
-            
-            # Clean temp PDF
-            if tmp_pdf.exists():
-                tmp_pdf.unlink()
-                
+            # PNG rendering (soffice -> pdftoppm) and markdown extraction
+            # (pptx2md) both read only the .pptx — run them concurrently.
+            def _render_pngs():
+                # The batched soffice pass usually produced the PDF already;
+                # fall back to a per-file conversion if this deck failed.
+                if prerendered_pdf is not None and prerendered_pdf.exists():
+                    pdf_to_pngs(prerendered_pdf, slides_png_dir, dpi=settings.dpi)
+                else:
+                    pptx_to_pngs(input_file, slides_png_dir, dpi=settings.dpi)
+
+            def _extract_md():
+                # Calling the library directly avoids forking a fresh
+                # interpreter (and re-importing python-pptx/lxml) per lecture.
+                # pptx2md keeps module-level state between calls, so the
+                # in-process path is serialized across concurrent lectures;
+                # extraction is a small slice of lecture wall time.
+                try:
+                    from pptx2md import convert as pptx2md_convert, ConversionConfig
+                    with _pptx2md_lock:
+                        pptx2md_convert(ConversionConfig(
+                            pptx_path=input_file,
+                            output_path=out_dir / "slides.md",
+                            image_dir=out_dir / "img",
+                            disable_image=True,
+                        ))
+                    return
+                except Exception as e:
+                    print(f"[warn] in-process pptx2md failed ({e}); falling back to CLI")
+                import subprocess
+                cmd = ["pptx2md", str(input_file), "-o", str(out_dir / "slides.md"), "--disable-image"]
+                subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+
+            await asyncio.gather(
+                asyncio.to_thread(_render_pngs),
+                asyncio.to_thread(_extract_md),
+            )
+
         elif input_file.suffix.lower() == ".pdf":
             # PDF -> PNGs
-            pdf_to_pngs(input_file, slides_png_dir, dpi=settings.dpi)
-            
+            await asyncio.to_thread(pdf_to_pngs, input_file, slides_png_dir, dpi=settings.dpi)
+
             # PDF -> Text (Markdown)
-            slides_text = pdf_utils.extract_text_from_pdf(input_file)
+            slides_text = await asyncio.to_thread(pdf_utils.extract_text_from_pdf, input_file)
             pdf_utils.write_slides_md(slides_text, slides_md_path)
             
         else:
@@ -63,16 +99,62 @@ def process_single_lecture(input_file: Path):
         bodies = [b for _, b in sections]
         slide_png_rels = [f"slides_png/slide{i+1:02d}.png" for i in range(len(sections))]
         
-        # Vision Batch Fix (if enabled)
+        # Vision Batch Fix (if enabled) — only slides whose markdown
+        # actually looks damaged are sent; clean slides skip the vision
+        # API entirely and results are spliced back by index.
         if settings.glitch_fix_with_png:
-            bodies = batch_clean_bodies_vision(out_dir, titles, bodies, slide_png_rels)
+            broken = [i for i, body in enumerate(bodies) if needs_vision_fix(body)]
+            if broken:
+                fixed = await abatch_clean_bodies_vision(
+                    out_dir,
+                    [titles[i] for i in broken],
+                    [bodies[i] for i in broken],
+                    [slide_png_rels[i] for i in broken],
+                )
+                for i, body in zip(broken, fixed):
+                    bodies[i] = body
             
+        # Append-only sidecar of finished per-slide fixes: a crashed or
+        # interrupted run resumes without re-paying the LLM calls for
+        # slides it already cleaned. Removed once the lecture completes.
+        clean_cache_path = out_dir / "slides_clean.jsonl"
+        clean_cache = {}
+        if clean_cache_path.exists():
+            for line in clean_cache_path.read_bytes().splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    rec = jsonio.loads(line)
+                    clean_cache[(rec["slide_index"], rec["title"])] = rec["body_md"]
+                except Exception:
+                    continue  # torn tail line from a crash mid-append
+
+        # Text Only Fix / Rewrite — slides are packed into multi-slide
+        # batches (one round-trip per batch instead of two per slide);
+        # batches run concurrently inside abatch_clean_rewrite. Slides
+        # already in the resume sidecar are excluded up front.
+        fixed_bodies = [clean_cache.get((i, t), body) for i, (t, body) in enumerate(zip(titles, bodies))]
+        pending = [(i, t, body) for i, (t, body) in enumerate(zip(titles, bodies)) if (i, t) not in clean_cache]
+        if pending:
+            def _append_batch(pairs):
+                # Fires as each batch completes, so a crash mid-pass only
+                # loses the batches still in flight. Records are keyed by
+                # position in the pending subset.
+                with open(clean_cache_path, "ab") as f:
+                    for local_idx, body in pairs:
+                        i, t, _ = pending[local_idx]
+                        f.write(jsonio.dumps_bytes({"slide_index": i, "title": t, "body_md": body}, indent=False) + b"\n")
+
+            fixed = await abatch_clean_rewrite(
+                [t for _, t, _ in pending],
+                [b for _, _, b in pending],
+                on_batch=_append_batch,
+            )
+            for (i, _, _), body in zip(pending, fixed):
+                fixed_bodies[i] = body
+
         blocks = []
-        for i, (title, body, png_rel) in enumerate(tqdm(zip(titles, bodies, slide_png_rels), total=len(titles), desc="Text Cleanup")):
-            # Text Only Fix / Rewrite
-            body = clean_body_md(title, body)
-            body = rewrite_body_md(title, body)
-            
+        for i, (title, body, png_rel) in enumerate(zip(titles, fixed_bodies, slide_png_rels)):
             extracted = find_extracted_images(body)
             blocks.append(SlideBlock(
                 slide_index=i,
@@ -82,68 +164,151 @@ def process_single_lecture(input_file: Path):
                 extracted_images=extracted
             ))
             
-        # Write slides.json
+        # Write slides.json (atomically, so a crash mid-write never leaves a
+        # half-written file that refresh would treat as valid)
         slides_json_path = out_dir / "slides.json"
-        with open(slides_json_path, "w") as f:
-            json.dump([asdict(b) for b in blocks], f, indent=2, ensure_ascii=False)
-            
-        # Overwrite slides.md with the CLEANED content so user sees the fix
-        with open(slides_md_path, "w", encoding="utf-8") as f:
-            for b in blocks:
-                f.write(f"# {b.title}\n\n")
-                f.write(f"{b.body_md}\n\n")
-                f.write("---\n\n")
+        tmp_json = slides_json_path.with_suffix(".json.tmp")
+        tmp_json.write_bytes(jsonio.dumps_bytes([asdict(b) for b in blocks]))
+        os.replace(tmp_json, slides_json_path)
+
+        # Overwrite slides.md with the CLEANED content so user sees the fix.
+        # One join + one write instead of three write() calls per slide.
+        tmp_md = slides_md_path.with_suffix(".md.tmp")
+        tmp_md.write_text(
+            "".join(f"# {b.title}\n\n{b.body_md}\n\n---\n\n" for b in blocks),
+            encoding="utf-8"
+        )
+        os.replace(tmp_md, slides_md_path)
+
+        # Final outputs are on disk — the resume sidecar is no longer needed
+        if clean_cache_path.exists():
+            clean_cache_path.unlink()
             
-        # 3. Summarize
-        summarize_lecture(out_dir, slides_json_path)
-        
+        # 3. Summarize (callers can defer this LLM-bound stage so it
+        # doesn't occupy whatever bounded the CPU-heavy stages)
+        if summarize:
+            await asummarize_lecture(out_dir, slides_json_path)
+
         print(f"[done] {input_file.name}")
-        
+        return out_dir, slides_json_path
+
     except Exception as e:
         print(f"[error] Failed {input_file.name}: {e}")
         import traceback
         traceback.print_exc()
+        return None
+
+async def _process_all(inputs, desc: str):
+    """Runs lecture coroutines concurrently, bounded by settings.max_workers.
+
+    All PPTX decks are converted to PDF up front in one soffice invocation
+    (one UNO bootstrap instead of one per deck); the per-lecture pipeline
+    then picks up its prerendered PDF from scratch space.
+    """
+    pptxs = [p for p in inputs if p.suffix.lower() == ".pptx"]
+    scratch_root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.TemporaryDirectory(dir=scratch_root) as scratch:
+        pdf_map = {}
+        if pptxs:
+            try:
+                pdf_map = await asyncio.to_thread(pptx_batch_to_pdf, pptxs, Path(scratch))
+            except Exception as e:
+                print(f"[warn] batched pptx->pdf failed ({e}); converting per lecture")
+
+        sem = asyncio.Semaphore(settings.max_workers)
+
+        async def _bounded(p: Path):
+            # Only the conversion/cleanup stages hold a worker slot. The
+            # final summary is a pure LLM wait, so it runs outside the
+            # semaphore: every finished lecture's summary is in flight
+            # while the freed slot starts the next lecture's CPU work,
+            # and each lecture_notes.tex lands as its response arrives.
+            async with sem:
+                res = await process_single_lecture(p, prerendered_pdf=pdf_map.get(p.stem), summarize=False)
+            if res is not None:
+                out_dir, slides_json_path = res
+                await asummarize_lecture(out_dir, slides_json_path)
+
+        tasks = [asyncio.ensure_future(_bounded(p)) for p in inputs]
+        with tqdm(total=len(tasks), desc=desc) as pbar:
+            for fut in asyncio.as_completed(tasks):
+                await fut
+                pbar.update(1)
+
+def _scan_inputs() -> list:
+    """Lecture files in settings.lectures_dir, sorted by name. One scandir
+    pass classifies by suffix instead of two glob passes that each stat
+    every dirent — noticeable when the lectures dir is a remote share."""
+    with os.scandir(settings.lectures_dir) as it:
+        inputs = [
+            Path(entry.path)
+            for entry in it
+            if entry.is_file()
+            and not entry.name.startswith(".")
+            and entry.name.lower().endswith((".pptx", ".pdf"))
+        ]
+    inputs.sort(key=lambda p: p.name)
+    return inputs
 
-def main():
+def _clean_intermediate():
+    """Removes per-lecture slides_png dirs. Deleting thousands of PNGs is
+    IOPS-latency-bound, so removals run across a thread pool."""
+    print("[info] Cleaning intermediate files...")
+    dirs = [
+        d / "slides_png"
+        for d in settings.out_root.iterdir()
+        if d.is_dir() and (d / "slides_png").exists()
+    ]
+    if dirs:
+        with ThreadPoolExecutor(max_workers=min(16, len(dirs))) as ex:
+            list(ex.map(shutil.rmtree, dirs))
+    print("[ok] Cleanup done.")
+
+def main(argv=None):
+    """CLI entry point. argv lets callers drive the pipeline in-process
+    (e.g. main(["process", "--limit", "2"])) instead of forking a fresh
+    interpreter that re-imports LangChain/Pillow/PyMuPDF and loses the
+    warm client pools and caches."""
     parser = argparse.ArgumentParser(description="Course Summarizer CLI")
-    parser.add_argument("command", choices=["process", "synthesize", "clean", "refresh"], default="process", nargs="?")
+    parser.add_argument("command", choices=["process", "synthesize", "summarize-chapters", "clean", "refresh"], default="process", nargs="?")
     parser.add_argument("--lectures_dir", default=None)
     parser.add_argument("--out_root", default=None)
     parser.add_argument("--compile-pdf", action="store_true", help="Compile LaTeX to PDF after synthesis")
     parser.add_argument("--clean-intermediate", action="store_true", help="Remove intermediate files like PNGs")
 
     parser.add_argument("--limit", type=int, default=None, help="Limit number of lectures to process")
-    
-    args = parser.parse_args()
-    
+    parser.add_argument("--vision_max_side", type=int, default=None, help="Downscale images sent to the vision API to this max dimension (0 disables)")
+    parser.add_argument("--vision_detail", default=None, choices=["low", "high", "auto"], help="Vision API detail hint")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the on-disk LLM response cache for this run")
+
+    args = parser.parse_args(argv)
+
     # Update settings from args
     if args.lectures_dir:
         settings.lectures_dir = Path(args.lectures_dir)
     if args.out_root:
         settings.out_root = Path(args.out_root)
+    if args.vision_max_side is not None:
+        settings.vision_max_side = args.vision_max_side
+    if args.vision_detail:
+        settings.vision_detail = args.vision_detail
+    if args.no_cache:
+        settings.llm_cache = False
         
     cmd = args.command
     
     if cmd == "process":
         settings.out_root.mkdir(parents=True, exist_ok=True)
         
-        inputs = list(settings.lectures_dir.glob("*.pptx")) + list(settings.lectures_dir.glob("*.pdf"))
-        # Filter hidden
-        inputs = [p for p in inputs if not p.name.startswith(".")]
-        inputs.sort()
+        inputs = _scan_inputs()
         
         if args.limit:
             inputs = inputs[:args.limit]
             
         print(f"Found {len(inputs)} lectures (limit={args.limit}).")
-        
-        from concurrent.futures import as_completed
 
-        with ThreadPoolExecutor(max_workers=settings.max_workers) as ex:
-             futures = [ex.submit(process_single_lecture, p) for p in inputs]
-             for _ in tqdm(as_completed(futures), total=len(inputs), desc="Processing Lectures"):
-                 pass
-             
+        asyncio.run(_process_all(inputs, "Processing Lectures"))
+
         print("\n[info] Processing complete. Running synthesis...")
         synthesize_course(settings.out_root)
         
@@ -157,12 +322,7 @@ def main():
                     print(f"[error] PDF compilation failed: {e}")
                     
         if args.clean_intermediate:
-            print("[info] Cleaning intermediate files...")
-            for d in settings.out_root.iterdir():
-                if d.is_dir() and (d / "slides_png").exists():
-                    import shutil
-                    shutil.rmtree(d / "slides_png")
-            print("[ok] Cleanup done.")
+            _clean_intermediate()
 
     elif cmd == "synthesize":
         synthesize_course(settings.out_root)
@@ -171,12 +331,26 @@ def main():
             if tex_file.exists():
                 latex_to_pdf(tex_file, clean=True)
 
+    elif cmd == "summarize-chapters":
+        # Re-summarize lectures one chapter per LLM call: request
+        # overhead and system-prompt prefill are paid per chapter
+        # instead of per lecture.
+        struct_path = settings.out_root / "synthesized" / "structure.json"
+        if not struct_path.exists():
+            infer_structure(settings.out_root)
+        if not struct_path.exists():
+            print("[error] No structure.json found — run process first.")
+            return
+        structure = jsonio.read_json(struct_path)
+        for ch in structure.get("chapters", []):
+            files = [f for part in ch.get("parts", []) for f in part.get("files", [])]
+            if files:
+                summarize_chapter(settings.out_root, files)
+
     elif cmd == "refresh":
         settings.out_root.mkdir(parents=True, exist_ok=True)
 
-        inputs = list(settings.lectures_dir.glob("*.pptx")) + list(settings.lectures_dir.glob("*.pdf"))
-        inputs = [p for p in inputs if not p.name.startswith(".")]
-        inputs.sort()
+        inputs = _scan_inputs()
 
         # Detect already-processed lectures
         already_done = {
@@ -191,12 +365,7 @@ def main():
         else:
             print(f"[info] Found {len(new_inputs)} new lecture(s) out of {len(inputs)} total. Processing...")
 
-            from concurrent.futures import as_completed
-
-            with ThreadPoolExecutor(max_workers=settings.max_workers) as ex:
-                futures = [ex.submit(process_single_lecture, p) for p in new_inputs]
-                for _ in tqdm(as_completed(futures), total=len(new_inputs), desc="Processing New Lectures"):
-                    pass
+            asyncio.run(_process_all(new_inputs, "Processing New Lectures"))
 
         # Always rebuild structure + synthesis so the course summary reflects all lectures
         struct_json = settings.out_root / "synthesized" / "structure.json"
@@ -217,16 +386,10 @@ def main():
                     print(f"[error] PDF compilation failed: {e}")
 
         if args.clean_intermediate:
-            print("[info] Cleaning intermediate files...")
-            for d in settings.out_root.iterdir():
-                if d.is_dir() and (d / "slides_png").exists():
-                    import shutil
-                    shutil.rmtree(d / "slides_png")
-            print("[ok] Cleanup done.")
+            _clean_intermediate()
 
     elif cmd == "clean":
         if settings.out_root.exists():
-            import shutil
             shutil.rmtree(settings.out_root)
             print("Output directory cleaned.")
 
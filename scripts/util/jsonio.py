@@ -0,0 +1,34 @@
+"""
+JSON helpers backed by orjson (a C extension, 3-10x faster than stdlib
+json on the nested structures we write), with a stdlib fallback so the
+pipeline still runs if orjson is not installed.
+"""
+import json
+from pathlib import Path
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_bytes(obj: Any, indent: bool = True) -> bytes:
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def write_json(path: Path, obj: Any, indent: bool = True) -> None:
+    path.write_bytes(dumps_bytes(obj, indent=indent))
+
+
+def read_json(path: Path) -> Any:
+    return loads(path.read_bytes())
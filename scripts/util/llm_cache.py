@@ -0,0 +1,77 @@
+"""
+Disk-backed response cache for LLM calls.
+
+Re-runs during iteration send byte-identical prompts; caching the response
+text keyed on (model, system, user, temperature, max_tokens, image bytes)
+turns those repeats into a local file read instead of a full-latency,
+full-cost provider round-trip. Caching applies to deterministic calls
+(temperature 0.0) unless settings.llm_cache_all opts the rest in.
+"""
+import functools
+import hashlib
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+from scripts.config import settings
+
+
+def enabled(temperature: float) -> bool:
+    if not settings.llm_cache:
+        return False
+    return temperature == 0.0 or settings.llm_cache_all
+
+
+@functools.lru_cache(maxsize=2048)
+def _image_digest(path: str, mtime_ns: int) -> str:
+    """First-64KB fingerprint — enough to distinguish image files."""
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(65536), digest_size=16).hexdigest()
+
+
+def make_key(
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    temperature: float,
+    max_output_tokens,
+    image_paths: Iterable[str] = (),
+) -> str:
+    h = hashlib.sha256()
+    for part in (model, str(temperature), str(max_output_tokens), system_prompt, user_prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    for p in image_paths:
+        try:
+            st = os.stat(p)
+            h.update(_image_digest(p, st.st_mtime_ns).encode("ascii"))
+        except OSError:
+            h.update(str(p).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _entry_path(key: str) -> Path:
+    # Sharded by the first key byte: directory lookups stay fast once the
+    # cache accumulates tens of thousands of entries (and match the
+    # {key[:2]}/ layout used by git's object store).
+    return settings.llm_cache_dir / key[:2] / f"{key}.txt"
+
+
+def get(key: str) -> Optional[str]:
+    path = _entry_path(key)
+    try:
+        return path.read_text(encoding="utf-8")
+    except OSError:
+        # Unsharded entry from an older cache layout
+        try:
+            return (settings.llm_cache_dir / f"{key}.txt").read_text(encoding="utf-8")
+        except OSError:
+            return None
+
+
+def put(key: str, text: str) -> None:
+    path = _entry_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".txt.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
@@ -1,9 +1,16 @@
 import fitz
+import functools
+import hashlib
+import os
 import pymupdf4llm
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List, Tuple
 import re
 
+from scripts.config import settings
+from scripts.util import jsonio
+
 ICON_FONTS = {"Wingdings", "Wingdings2", "Wingdings3", "Symbol", "ZapfDingbats"}
 
 # Presentation tools that produce PDFs better handled by fitz dict mode
@@ -28,17 +35,28 @@ def _is_presentation_origin(doc: fitz.Document) -> bool:
     return False
 
 
-def _image_block_ratio(doc: fitz.Document, sample_pages: int = 5) -> float:
+def _sample_page_dicts(doc: fitz.Document, sample_pages: int = 5) -> dict:
+    """
+    Dict-mode extraction of the first few pages, keyed by page number.
+    get_text("dict") is the slowest MuPDF call here, so the sample is
+    fetched once and shared between the pre-flight signals and the
+    actual fitz extraction.
+    """
+    return {
+        i: doc[i].get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)
+        for i in range(min(len(doc), sample_pages))
+    }
+
+
+def _image_block_ratio(page_dicts: dict) -> float:
     """
-    Return the fraction of blocks that are images across a sample of pages.
-    A high ratio (> 0.4) suggests scanned or PPTX-converted content.
+    Return the fraction of blocks that are images across the sampled
+    pages. A high ratio (> 0.4) suggests scanned or PPTX-converted content.
     """
     total_blocks = 0
     image_blocks = 0
-    pages_to_check = min(len(doc), sample_pages)
-    for i in range(pages_to_check):
-        blocks = doc[i].get_text("dict", flags=0).get("blocks", [])
-        for b in blocks:
+    for d in page_dicts.values():
+        for b in d.get("blocks", []):
             total_blocks += 1
             if b.get("type") == 1:          # image block
                 image_blocks += 1
@@ -75,6 +93,12 @@ def _is_landscape(doc: fitz.Document) -> bool:
 
 _MIN_CHARS_PER_PAGE = 30
 
+# Non-blank lines with surrounding whitespace trimmed, and lines opening
+# with a heading marker. Both run as single C-level scans per page, so
+# the scorer never loops over individual lines in Python.
+_NONBLANK_LINE_RE = re.compile(r"(?m)^[ \t]*(\S[^\n]*?)[ \t\r]*$")
+_HEADING_LINE_RE = re.compile(r"(?m)^[ \t]*#")
+
 def _score_md_quality(pages_md: list) -> float:
     """
     Score 0-1 for how well-structured the pymupdf4llm markdown output is.
@@ -94,15 +118,10 @@ def _score_md_quality(pages_md: list) -> float:
         if not md:
             continue
         nonempty_count += 1
-        lines = md.split("\n")
-        for line in lines:
-            stripped = line.strip()
-            if not stripped:
-                continue
-            total_lines += 1
-            total_line_len += len(stripped)
-            if stripped.startswith("#"):
-                heading_count += 1
+        lines = _NONBLANK_LINE_RE.findall(md)
+        total_lines += len(lines)
+        total_line_len += sum(map(len, lines))
+        heading_count += len(_HEADING_LINE_RE.findall(md))
 
     if total_lines == 0:
         return 0.0
@@ -146,70 +165,88 @@ def _extract_via_pymupdf4llm(pdf_path: Path) -> List[Tuple[str, str]]:
 # Strategy 2: fitz dict mode (fallback for PPTX-converted / image-heavy PDFs)
 # ---------------------------------------------------------------------------
 
-def _is_icon_span(span: dict) -> bool:
-    font = span.get("font", "")
+@functools.lru_cache(maxsize=256)
+def _is_icon_font(font: str) -> bool:
+    """Memoized per font name: a deck uses the same 3-4 fonts across
+    thousands of spans, so the substring scan runs once per font."""
     return any(icon in font for icon in ICON_FONTS)
 
 
-def _extract_page_fitz(page) -> Tuple[str, str]:
-    """Font-size-aware extraction from a single page."""
-    d = page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)
+def _is_icon_span(span: dict) -> bool:
+    return _is_icon_font(span.get("font", ""))
+
+
+# A line already ending in one of these doesn't get the next line merged
+# into it; set membership on the last character beats a regex search.
+_END_PUNCT = frozenset(".!?:;,)]}")
 
-    spans_data = []
+
+def _extract_page_fitz(page, d: dict = None) -> Tuple[str, str]:
+    """Font-size-aware extraction from a single page. An already-fetched
+    dict-mode extraction can be passed in to avoid refetching it."""
+    if d is None:
+        d = page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)
+
+    # Structure-of-arrays collection: parallel lists instead of a dict
+    # per span, with the icon/page-number filter folded into the same
+    # pass. On 200+ spans/page this drops most of the allocation and
+    # lookup overhead of the old dict-list + second filter pass.
+    span_blocks: List[int] = []
+    span_lines: List[int] = []
+    span_sizes: List[float] = []
+    span_texts: List[str] = []
+    is_icon = _is_icon_span
     for bi, block in enumerate(d.get("blocks", [])):
         if block.get("type") != 0:
             continue
         for li, line in enumerate(block.get("lines", [])):
-            for si, span in enumerate(line.get("spans", [])):
+            for span in line.get("spans", []):
                 text = span.get("text", "").strip()
-                if not text:
+                if not text or is_icon(span):
                     continue
-                spans_data.append({
-                    "block": bi, "line": li, "span": si,
-                    "size": span.get("size", 12),
-                    "text": text,
-                    "is_icon": _is_icon_span(span),
-                })
-
-    if not spans_data:
-        return (f"Slide {page.number + 1}", "")
+                size = span.get("size", 12)
+                # Bare 1-3 digit spans in small type are page numbers
+                if size < 20 and len(text) <= 3 and text.isdigit():
+                    continue
+                span_blocks.append(bi)
+                span_lines.append(li)
+                span_sizes.append(size)
+                span_texts.append(text)
 
-    content_spans = [
-        s for s in spans_data
-        if not s["is_icon"] and not (re.match(r"^\d{1,3}$", s["text"]) and s["size"] < 20)
-    ]
-    if not content_spans:
+    if not span_texts:
         return (f"Slide {page.number + 1}", "")
 
-    max_size = max(s["size"] for s in content_spans)
+    max_size = max(span_sizes)
     title_threshold = max_size - 2
     title_parts, body_lines_by_block, title_block = [], {}, None
 
-    for s in content_spans:
-        if s["size"] >= title_threshold and title_block is None:
-            title_block = s["block"]
-        if s["size"] >= title_threshold and s["block"] == title_block:
-            title_parts.append(s)
+    for i, text in enumerate(span_texts):
+        size = span_sizes[i]
+        bkey = span_blocks[i]
+        if size >= title_threshold and title_block is None:
+            title_block = bkey
+        if size >= title_threshold and bkey == title_block:
+            title_parts.append(text)
         else:
-            bkey = s["block"]
-            if bkey not in body_lines_by_block:
-                body_lines_by_block[bkey] = []
-            line_key = (s["block"], s["line"])
-            if body_lines_by_block[bkey] and body_lines_by_block[bkey][-1]["_key"] == line_key:
-                body_lines_by_block[bkey][-1]["text"] += " " + s["text"]
+            rows = body_lines_by_block.get(bkey)
+            if rows is None:
+                rows = body_lines_by_block[bkey] = []
+            line_key = (bkey, span_lines[i])
+            if rows and rows[-1][1] == line_key:
+                rows[-1][0] += " " + text
             else:
-                body_lines_by_block[bkey].append({"text": s["text"], "_key": line_key})
+                rows.append([text, line_key])
 
-    title = " ".join(s["text"] for s in title_parts).strip() or f"Slide {page.number + 1}"
+    title = " ".join(title_parts).strip() or f"Slide {page.number + 1}"
 
     paragraphs = []
     for bkey in sorted(body_lines_by_block.keys()):
         merged = []
-        for line_data in body_lines_by_block[bkey]:
-            text = line_data["text"].strip()
+        for row in body_lines_by_block[bkey]:
+            text = row[0].strip()
             if not text:
                 continue
-            if merged and not re.search(r"[.!?:;,\)\]\}]$", merged[-1]):
+            if merged and merged[-1][-1] not in _END_PUNCT:
                 merged[-1] += " " + text
             else:
                 merged.append(text)
@@ -217,25 +254,78 @@ def _extract_page_fitz(page) -> Tuple[str, str]:
             paragraphs.append("\n".join(merged))
 
     body = "\n\n".join(paragraphs)
-    body = re.sub(r"\n{3,}", "\n\n", body)
+    # C-level replace loop; usually zero iterations since paragraphs are
+    # joined with exactly two newlines.
+    while "\n\n\n" in body:
+        body = body.replace("\n\n\n", "\n\n")
     return (title, body)
 
 
-def _extract_via_fitz(pdf_path: Path) -> List[Tuple[str, str]]:
-    """Font-size-aware fitz extraction for all pages."""
-    doc = fitz.open(pdf_path)
-    return [_extract_page_fitz(page) for page in doc]
+# Per-worker open-document cache: fitz.Page isn't picklable, so workers
+# receive (path, page_index) and each process opens the doc exactly once.
+_WORKER_DOCS: dict = {}
+
+# Below this page count the pool spin-up costs more than the extraction.
+_MIN_PAGES_FOR_POOL = 8
+
+
+def _extract_page_worker(args: Tuple[str, int]) -> Tuple[str, str]:
+    pdf_path, index = args
+    doc = _WORKER_DOCS.get(pdf_path)
+    if doc is None:
+        doc = _WORKER_DOCS[pdf_path] = fitz.open(pdf_path)
+    return _extract_page_fitz(doc[index])
+
+
+def _extract_via_fitz(pdf_path: Path, doc: fitz.Document = None, page_dicts: dict = None) -> List[Tuple[str, str]]:
+    """
+    Font-size-aware fitz extraction for all pages.
+
+    Page extraction is independent, CPU-bound Python, so large decks fan
+    out across a process pool (threads would just contend on the GIL);
+    short documents stay on the serial path. An already-open Document can
+    be passed in to avoid a redundant open; the caller keeps ownership.
+    """
+    owns_doc = doc is None
+    if owns_doc:
+        doc = fitz.open(pdf_path)
+    try:
+        n = len(doc)
+        workers = min(os.cpu_count() or 1, n)
+        if page_dicts is None:
+            page_dicts = {}
+        if n < _MIN_PAGES_FOR_POOL or workers < 2:
+            # Short docs reuse whatever dicts the pre-flight already
+            # fetched instead of repeating the slowest MuPDF call.
+            return [_extract_page_fitz(page, page_dicts.get(page.number)) for page in doc]
+
+        path = str(pdf_path)
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                # chunksize amortizes IPC over several pages per task;
+                # workers refetch their own dicts (only the handful of
+                # sampled pages are duplicated).
+                return list(ex.map(_extract_page_worker, ((path, i) for i in range(n)), chunksize=4))
+        except Exception:
+            # Pool failures (restricted environments, broken workers) are
+            # not worth dying over — redo the extraction serially.
+            return [_extract_page_fitz(page, page_dicts.get(page.number)) for page in doc]
+    finally:
+        if owns_doc:
+            doc.close()
 
 
 # ---------------------------------------------------------------------------
 # Public API
 # ---------------------------------------------------------------------------
 
-def _pick_strategy(pdf_path: Path) -> str:
+def _pick_strategy(doc: fitz.Document, page_dicts: dict) -> str:
     """
     Decide which extraction strategy to use based on PDF characteristics.
 
-    Returns "fitz" or "pymupdf4llm".
+    Returns "fitz" or "pymupdf4llm". Operates on an already-open Document
+    and pre-fetched sample page dicts so the pre-flight shares one open
+    (and one dict extraction per sampled page) with the extraction itself.
 
     Decision signals (checked in order of cost):
       1. Metadata   – creator/producer mentions a presentation tool  → fitz
@@ -243,27 +333,38 @@ def _pick_strategy(pdf_path: Path) -> str:
       3. Image ratio – >40% image blocks in a sample of pages        → fitz
       4. Otherwise   – default to pymupdf4llm (best for native docs)
     """
-    doc = fitz.open(pdf_path)
-
     # Signal 1: creator metadata
     if _is_presentation_origin(doc):
-        doc.close()
         return "fitz"
 
     # Signal 2: landscape slides with identical dimensions
     if _is_landscape(doc) and _has_uniform_page_size(doc):
-        doc.close()
         return "fitz"
 
     # Signal 3: high image content
-    if _image_block_ratio(doc) > 0.4:
-        doc.close()
+    if _image_block_ratio(page_dicts) > 0.4:
         return "fitz"
 
-    doc.close()
     return "pymupdf4llm"
 
 
+def _pdf_fingerprint(pdf_path: Path) -> str:
+    """
+    Fast content fingerprint: (mtime_ns, size, first 64KB). Cheap enough to
+    compute on every run, specific enough that any edit to the PDF — or a
+    re-export with the same byte length — invalidates the cached extraction.
+    """
+    st = pdf_path.stat()
+    h = hashlib.sha256(f"{st.st_mtime_ns}:{st.st_size}:".encode("ascii"))
+    with open(pdf_path, "rb") as f:
+        h.update(f.read(65536))
+    return h.hexdigest()
+
+
+def _cache_path(pdf_path: Path) -> Path:
+    return settings.out_root / ".pdf_cache" / f"{_pdf_fingerprint(pdf_path)[:16]}.json"
+
+
 def extract_text_from_pdf(pdf_path: Path) -> List[Tuple[str, str]]:
     """
     Extracts text from a PDF.
@@ -271,25 +372,58 @@ def extract_text_from_pdf(pdf_path: Path) -> List[Tuple[str, str]]:
     Uses structural heuristics (metadata, geometry, image ratio) to pick the
     best strategy upfront.  When pymupdf4llm is chosen, a quality check on
     the output can still trigger a fallback to font-aware fitz extraction.
-    """
-    strategy = _pick_strategy(pdf_path)
 
-    if strategy == "fitz":
-        return _extract_via_fitz(pdf_path)
-
-    # Try pymupdf4llm and verify output quality
-    pages_md = pymupdf4llm.to_markdown(str(pdf_path), page_chunks=True)
+    Results are cached on disk keyed by a file fingerprint, so re-runs skip
+    the (seconds-per-file) parse entirely; a changed PDF gets a new
+    fingerprint and the stale entry is simply never read again.
+    """
+    try:
+        cache_path = _cache_path(pdf_path)
+        cached = jsonio.read_json(cache_path)
+    except (OSError, ValueError):
+        cached = None
+    if cached is not None:
+        return [(title, body) for title, body in cached]
+
+    slides = _extract_text_uncached(pdf_path)
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(".json.tmp")
+        jsonio.write_json(tmp, slides, indent=False)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # cache is best-effort; extraction already succeeded
+    return slides
 
-    # Quick sparseness check
-    total_chars = sum(len(p.get("text", "")) for p in pages_md)
-    avg_chars = total_chars / max(len(pages_md), 1)
-    if avg_chars < _MIN_CHARS_PER_PAGE:
-        return _extract_via_fitz(pdf_path)
 
-    # Structural quality check
-    quality = _score_md_quality(pages_md)
-    if quality < 0.35:
-        return _extract_via_fitz(pdf_path)
+def _extract_text_uncached(pdf_path: Path) -> List[Tuple[str, str]]:
+    # One fitz open per PDF: pre-flight signals, the fitz path and
+    # pymupdf4llm all share this Document instead of each re-parsing the
+    # xref table from disk.
+    doc = fitz.open(pdf_path)
+    try:
+        page_dicts = _sample_page_dicts(doc)
+        strategy = _pick_strategy(doc, page_dicts)
+
+        if strategy == "fitz":
+            return _extract_via_fitz(pdf_path, doc, page_dicts)
+
+        # Try pymupdf4llm and verify output quality
+        pages_md = pymupdf4llm.to_markdown(doc, page_chunks=True)
+
+        # Quick sparseness check
+        total_chars = sum(len(p.get("text", "")) for p in pages_md)
+        avg_chars = total_chars / max(len(pages_md), 1)
+        if avg_chars < _MIN_CHARS_PER_PAGE:
+            return _extract_via_fitz(pdf_path, doc, page_dicts)
+
+        # Structural quality check
+        quality = _score_md_quality(pages_md)
+        if quality < 0.35:
+            return _extract_via_fitz(pdf_path, doc, page_dicts)
+    finally:
+        doc.close()
 
     # Good quality – parse into (title, body) tuples
     slides = []
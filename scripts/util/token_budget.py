@@ -0,0 +1,61 @@
+"""
+Token-budget truncation for prompt payloads.
+
+Character slices are a poor proxy for context consumption (LaTeX and JSON
+run ~3-4 chars per token, math-heavy text less), so payloads are measured
+with tiktoken and trimmed against a real token budget. Fitting precisely
+avoids context-limit rejects and keeps prefill cost proportional to what
+the model actually needs to read.
+"""
+import functools
+from typing import List, Sequence
+
+import tiktoken
+
+# OpenRouter model ids (vendor/model) aren't in tiktoken's registry;
+# cl100k_base is close enough for budgeting purposes.
+_FALLBACK_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=8)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(_FALLBACK_ENCODING)
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(_encoding(model).encode(text))
+
+
+def truncate(text: str, model: str, budget: int) -> str:
+    """Longest prefix of text that fits the budget, cut on a token boundary."""
+    if budget <= 0:
+        return ""
+    enc = _encoding(model)
+    ids = enc.encode(text)
+    if len(ids) <= budget:
+        return text
+    return enc.decode(ids[:budget])
+
+
+def cap_blocks(blocks: Sequence[str], model: str, budget: int, overhead: int = 0) -> List[str]:
+    """
+    Longest prefix of blocks whose combined token count (plus overhead)
+    fits the budget. Blocks are encoded one at a time so nothing past the
+    cut is ever tokenized. At least one block is always kept; callers
+    that drop blocks should append their own deterministic truncation
+    marker so the model knows the payload was trimmed.
+    """
+    enc = _encoding(model)
+    encode = enc.encode
+    used = overhead
+    kept: List[str] = []
+    for block in blocks:
+        n = len(encode(block))
+        if kept and used + n > budget:
+            break
+        kept.append(block)
+        used += n
+    return kept